@@ -3,10 +3,23 @@ os.environ.setdefault("HOME", "/opt/home")
 os.environ.setdefault("XDG_CACHE_HOME", "/opt/xdg-cache")
 os.environ.setdefault("CAMOUFOX_CACHE_DIR", "/opt/camoufox-cache")
 
+import re
+import sys
 import json
+import math
+import time
+import hashlib
+import gzip
+import random
+import signal
 import asyncio
+import threading
 import logging
+import itertools
 from typing import Optional, Any, Dict
+from email.utils import parsedate_to_datetime
+from contextvars import ContextVar
+from collections import deque, OrderedDict
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Query, Request
@@ -24,6 +37,8 @@ logging.basicConfig(level=logging.INFO)
 
 API_KEY = os.getenv("API_KEY")  # защищает /private/*
 PROXY = os.getenv("CHIZHIK_PROXY")  # опционально
+# несколько прокси через запятую: на каждый свои браузеры, нагрузка делится между ними
+PROXIES = [x.strip() for x in os.getenv("CHIZHIK_PROXIES", "").split(",") if x.strip()] or [PROXY]
 HEADLESS = os.getenv("CHIZHIK_HEADLESS", "true").lower() == "true"
 
 ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "https://chizhick.ru,https://www.chizhick.ru")
@@ -31,140 +46,2893 @@ ALLOWED_ORIGINS_LIST = [x.strip() for x in ALLOWED_ORIGINS.split(",") if x.strip
 
 REDIS_URL = os.getenv("REDIS_URL")
 CHIZHIK_TIMEOUT_SEC = int(os.getenv("CHIZHIK_TIMEOUT_SEC", "80"))
+# сколько браузеров (ChizhikAPI) держим параллельно (не меньше одного на прокси)
+CHIZHIK_POOL_SIZE = max(1, len(PROXIES), int(os.getenv("CHIZHIK_POOL_SIZE", "1")))
+# сколько прогретых браузеров держать в горячем резерве на случай падения сессии
+CHIZHIK_STANDBY = max(0, int(os.getenv("CHIZHIK_STANDBY", "0")))
+STANDBY_RETRY_SEC = float(os.getenv("STANDBY_RETRY_SEC", "30"))
+# плановый перезапуск браузера: после N вызовов, T минут жизни или RSS дерева процессов (0 — выкл.)
+RECYCLE_MAX_CALLS = int(os.getenv("RECYCLE_MAX_CALLS", "0"))
+RECYCLE_MAX_AGE_MIN = float(os.getenv("RECYCLE_MAX_AGE_MIN", "0"))
+RECYCLE_MAX_RSS_MB = float(os.getenv("RECYCLE_MAX_RSS_MB", "0"))
+RECYCLE_CHECK_SEC = float(os.getenv("RECYCLE_CHECK_SEC", "60"))
+# admission control: больше стольких ждущих или дольше стольких секунд ожидаемого ожидания — 429
+UPSTREAM_MAX_QUEUE = int(os.getenv("UPSTREAM_MAX_QUEUE", "100"))
+UPSTREAM_MAX_WAIT_SEC = float(os.getenv("UPSTREAM_MAX_WAIT_SEC", "60"))
+# повторы на той же сессии для временных ошибок (сеть, 5xx)
+RETRY_MAX = int(os.getenv("RETRY_MAX", "2"))
+RETRY_BASE_MS = float(os.getenv("RETRY_BASE_MS", "200"))
+RETRY_MAX_BACKOFF_MS = float(os.getenv("RETRY_MAX_BACKOFF_MS", "3000"))
+# прямой HTTP: браузер только добывает cookies/заголовки, JSON берём пулом httpx с keep-alive
+DIRECT_HTTP = os.getenv("CHIZHIK_DIRECT_HTTP", "false").lower() == "true"
+DIRECT_BASE_URL = os.getenv("CHIZHIK_DIRECT_BASE_URL", "https://app.chizhik.club/api/v1").rstrip("/")
+DIRECT_ORIGIN = os.getenv("CHIZHIK_DIRECT_ORIGIN", "https://chizhik.club")
+DIRECT_CREDS_TTL_SEC = float(os.getenv("CHIZHIK_DIRECT_CREDS_TTL_SEC", "900"))
+DIRECT_MAX_CONNECTIONS = int(os.getenv("CHIZHIK_DIRECT_MAX_CONNECTIONS", "20"))
+# микробатчинг product_info: промахи за окно (мс) или до max штук идут одним checkout сессии
+PRODUCT_BATCH_WINDOW_MS = float(os.getenv("PRODUCT_BATCH_WINDOW_MS", "0"))
+PRODUCT_BATCH_MAX = max(1, int(os.getenv("PRODUCT_BATCH_MAX", "20")))
+# /public/catalog/products/all: сколько страниц тянуть параллельно и максимум страниц
+FANOUT_CONCURRENCY = max(1, int(os.getenv("FANOUT_CONCURRENCY", "4")))
+FANOUT_MAX_PAGES = max(1, int(os.getenv("FANOUT_MAX_PAGES", "50")))
+# бюджет запроса: заголовок X-Request-Budget-Ms или дефолт по префиксу пути
+# ("/public/geo=15,/public/catalog/tree=170"), иначе REQUEST_BUDGET_SEC
+REQUEST_BUDGET_SEC = float(os.getenv("REQUEST_BUDGET_SEC", str(CHIZHIK_TIMEOUT_SEC * 2 + 10)))
+REQUEST_BUDGET_MAX_SEC = float(os.getenv("REQUEST_BUDGET_MAX_SEC", "300"))
+REQUEST_BUDGETS = sorted(
+    ((k.strip(), float(v)) for k, v in (x.split("=", 1) for x in os.getenv("REQUEST_BUDGETS", "").split(",") if "=" in x)),
+    key=lambda kv: -len(kv[0]),
+)
+# прогрев после старта: какие деревья городов и первые страницы каких категорий загрузить в кэш
+WARMUP_CITIES = [x.strip() for x in os.getenv("WARMUP_CITIES", "").split(",") if x.strip()]
+WARMUP_CATEGORIES = [int(x) for x in os.getenv("WARMUP_CATEGORIES", "").split(",") if x.strip()]
+WARMUP_PRODUCT_PAGES = max(1, int(os.getenv("WARMUP_PRODUCT_PAGES", "1")))
+WARMUP_CONCURRENCY = max(1, int(os.getenv("WARMUP_CONCURRENCY", str(CHIZHIK_POOL_SIZE))))
+# если задан — браузеры живут в отдельном процессе-брокере (python app.py broker),
+# а HTTP-воркеры ходят к нему через этот unix socket
+BROKER_SOCKET = os.getenv("CHIZHIK_BROKER_SOCKET")
+# через сколько секунд ожидания вызов поднимается на один класс приоритета
+SCHED_AGING_SEC = float(os.getenv("SCHED_AGING_SEC", "10"))
+# адаптивные таймауты по операциям: p99 * factor в пределах [floor, ceil],
+# пока замеров мало — CHIZHIK_TIMEOUT_SEC; явные значения: "catalog_tree=120,geo_cities=10"
+TIMEOUT_P99_FACTOR = float(os.getenv("TIMEOUT_P99_FACTOR", "3"))
+TIMEOUT_FLOOR_SEC = float(os.getenv("TIMEOUT_FLOOR_SEC", "5"))
+TIMEOUT_CEIL_SEC = float(os.getenv("TIMEOUT_CEIL_SEC", str(CHIZHIK_TIMEOUT_SEC)))
+TIMEOUT_MIN_SAMPLES = int(os.getenv("TIMEOUT_MIN_SAMPLES", "20"))
+TIMEOUT_WINDOW = int(os.getenv("TIMEOUT_WINDOW", "200"))
+TIMEOUT_OVERRIDES = {
+    k.strip(): float(v)
+    for k, v in (x.split("=", 1) for x in os.getenv("CHIZHIK_TIMEOUT_OVERRIDES", "").split(",") if "=" in x)
+}
+# bulkhead'ы: своя доля браузеров и своя очередь на семейство ручек, "family=limit:queue",
+# например "tree=1:10,products=2:50"; по умолчанию каждое семейство может занять все браузеры,
+# кроме одного (при пуле из одного браузера — сам браузер, но очереди раздельные)
+BULKHEAD_DEFAULT_LIMIT = int(os.getenv("BULKHEAD_DEFAULT_LIMIT", str(max(1, CHIZHIK_POOL_SIZE - 1))))
+BULKHEAD_DEFAULT_QUEUE = int(os.getenv("BULKHEAD_DEFAULT_QUEUE", "100"))
+BULKHEADS = {
+    k.strip(): tuple(int(x) for x in v.split(":", 1)) if ":" in v else (int(v), BULKHEAD_DEFAULT_QUEUE)
+    for k, v in (x.split("=", 1) for x in os.getenv("BULKHEADS", "").split(",") if "=" in x)
+}
+# выкидываем прокси на PROXY_EJECT_SEC, если доля ошибок (EWMA) >= PROXY_EJECT_ERROR_RATE
+# или латентность в PROXY_EJECT_LATENCY_FACTOR раз хуже медианы остальных; последний не трогаем
+PROXY_EJECT_ERROR_RATE = float(os.getenv("PROXY_EJECT_ERROR_RATE", "0.5"))
+PROXY_EJECT_LATENCY_FACTOR = float(os.getenv("PROXY_EJECT_LATENCY_FACTOR", "3"))
+PROXY_EJECT_SEC = float(os.getenv("PROXY_EJECT_SEC", "60"))
+PROXY_MIN_CALLS = int(os.getenv("PROXY_MIN_CALLS", "10"))
+# адаптивный лимит одновременных вызовов апстрима (AIMD) в пределах
+# [CONCURRENCY_MIN, CONCURRENCY_MAX]; без CONCURRENCY_ADAPTIVE лимит = размер пула.
+# Выше размера пула лимит не растёт: сессия занята одним вызовом (рестарт и челлендж
+# перезагружают её страницу), так что AIMD только придерживает пул, когда chizhik не справляется
+CONCURRENCY_ADAPTIVE = os.getenv("CONCURRENCY_ADAPTIVE", "false").lower() == "true"
+CONCURRENCY_MAX = max(1, int(os.getenv("CONCURRENCY_MAX", str(CHIZHIK_POOL_SIZE))))
+if CONCURRENCY_MAX > CHIZHIK_POOL_SIZE:
+    logger.warning(
+        "CONCURRENCY_MAX=%d is above CHIZHIK_POOL_SIZE=%d: one call per browser, using %d",
+        CONCURRENCY_MAX, CHIZHIK_POOL_SIZE, CHIZHIK_POOL_SIZE,
+    )
+    CONCURRENCY_MAX = CHIZHIK_POOL_SIZE
+CONCURRENCY_MIN = max(1, min(CONCURRENCY_MAX, int(os.getenv("CONCURRENCY_MIN", "1"))))
+CONCURRENCY_BACKOFF = float(os.getenv("CONCURRENCY_BACKOFF", "0.75"))
+CONCURRENCY_LATENCY_TOLERANCE = float(os.getenv("CONCURRENCY_LATENCY_TOLERANCE", "2"))
+# сигнал латентности — медиана последних CONCURRENCY_LATENCY_SAMPLES вызовов операции, не один вызов
+CONCURRENCY_LATENCY_SAMPLES = max(1, int(os.getenv("CONCURRENCY_LATENCY_SAMPLES", "10")))
+# L1-кэш в памяти процесса перед Redis: лимит в МБ на пространство ключей (первая часть ключа),
+# "ns=MB", например "geo=8,catalog=32,product=16"; прочие пространства — L1_CACHE_DEFAULT_MB
+L1_CACHE = os.getenv("L1_CACHE", "true").lower() == "true"
+L1_CACHE_DEFAULT_MB = float(os.getenv("L1_CACHE_DEFAULT_MB", "4"))
+L1_CACHE_LIMITS = {
+    k.strip(): float(v)
+    for k, v in (x.split("=", 1) for x in os.getenv("L1_CACHE_LIMITS", "geo=8,catalog=32,product=16,offers=1").split(",") if "=" in x)
+}
+# ответы в кэше хранятся готовыми байтами JSON + gzip (и brotli при CACHE_BROTLI и пакете brotli),
+# если тело не меньше CACHE_COMPRESS_MIN_BYTES; попадания отдаются без разбора и сжатия
+CACHE_COMPRESS_MIN_BYTES = int(os.getenv("CACHE_COMPRESS_MIN_BYTES", "1000"))
+CACHE_GZIP_LEVEL = int(os.getenv("CACHE_GZIP_LEVEL", "6"))
+CACHE_BROTLI = os.getenv("CACHE_BROTLI", "false").lower() == "true"
+# кодек значений в кэше: json | orjson | msgspec — для ответов ручек (тело отдаётся как есть,
+# поэтому только JSON); CACHE_INTERNAL_CODEC (по умолчанию тот же) — для служебных значений,
+# там можно и msgpack. Формат кодека входит в префикс ключа — смена кодека не читает чужое
+CACHE_CODEC = os.getenv("CACHE_CODEC", "json").lower()
+CACHE_INTERNAL_CODEC = os.getenv("CACHE_INTERNAL_CODEC", CACHE_CODEC).lower()
+# cookies/storage_state здорового браузера сохраняются (Redis, иначе SESSION_STATE_FILE) и
+# подставляются новым браузерам при запуске — антибот-прогрев не проходим заново.
+# SESSION_STATE_TTL_SEC — срок жизни сохранённого состояния, 0 — выкл.
+SESSION_STATE_TTL_SEC = int(os.getenv("SESSION_STATE_TTL_SEC", "0"))
+SESSION_STATE_SAVE_SEC = float(os.getenv("SESSION_STATE_SAVE_SEC", "300"))
+SESSION_STATE_FILE = os.getenv("SESSION_STATE_FILE", "")
+# hedging: если вызов interactive не закончился за p(HEDGE_QUANTILE) латентности операции,
+# тот же запрос уходит на второй свободный браузер, берём первый ответ. HEDGE_BUDGET — доля
+# дополнительных вызовов (0.05 = не больше 5% сверху), 0 — выключено
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0"))
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+if HEDGE_BUDGET > 0 and CHIZHIK_POOL_SIZE >= 2 and "BULKHEAD_DEFAULT_LIMIT" not in os.environ:
+    # дублю нужен второй слот семейства: на пуле из двух «все, кроме одного» = 1 выключило бы hedging
+    BULKHEAD_DEFAULT_LIMIT = max(BULKHEAD_DEFAULT_LIMIT, 2)
+# circuit breaker: открываемся после N ошибок подряд или доли ошибок в окне последних вызовов
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_OPEN_SEC = float(os.getenv("BREAKER_OPEN_SEC", "30"))
+# stale-while-revalidate: TTL_*_SEC ручки — мягкий TTL, жёсткий = мягкий × CACHE_HARD_TTL_FACTOR
+# (но не меньше STALE_TTL_SEC). Между ними отдаём устаревший ответ сразу и обновляем его в фоне
+CACHE_HARD_TTL_FACTOR = max(1.0, float(os.getenv("CACHE_HARD_TTL_FACTOR", "1")))
+STALE_TTL_SEC = int(os.getenv("STALE_TTL_SEC", "0"))
+SWR_REFRESH_LOCK_SEC = int(os.getenv("SWR_REFRESH_LOCK_SEC", "60"))
+# ключ строит другой инстанс (lock занят): ждём его результата через Redis pub/sub
+# не дольше BUILD_WAIT_SEC, потом 202 {"status": "building"}
+BUILD_WAIT_SEC = float(os.getenv("BUILD_WAIT_SEC", "30"))
+BROKER_TIMEOUT_SEC = int(os.getenv("CHIZHIK_BROKER_TIMEOUT_SEC", str(CHIZHIK_TIMEOUT_SEC * 2 + 30)))
+
+TTL_GEO_SEC = int(os.getenv("TTL_GEO_SEC", str(24 * 60 * 60)))
+TTL_OFFERS_SEC = int(os.getenv("TTL_OFFERS_SEC", str(10 * 60)))
+TTL_TREE_SEC = int(os.getenv("TTL_TREE_SEC", str(24 * 60 * 60)))
+TTL_PRODUCTS_SEC = int(os.getenv("TTL_PRODUCTS_SEC", str(5 * 60)))
+TTL_PRODUCT_INFO_SEC = int(os.getenv("TTL_PRODUCT_INFO_SEC", str(60 * 60)))
+
+# Redis
+rds = None
+try:
+    import redis.asyncio as redis
+except Exception:
+    redis = None
+
+# brotli — дополнительный вариант сжатия ответов в кэше (опционально)
+try:
+    import brotli
+except Exception:
+    brotli = None
+
+# быстрые кодеки кэша (опционально, см. CACHE_CODEC)
+try:
+    import orjson
+except Exception:
+    orjson = None
+try:
+    import msgspec
+except Exception:
+    msgspec = None
+try:
+    import msgpack
+except Exception:
+    msgpack = None
+
+# httpx — для прямых JSON-запросов в обход браузера (опционально)
+try:
+    import httpx
+except Exception:
+    httpx = None
+
+_warmup_state = {"status": "starting", "error": None, "phase": None, "done": 0, "total": 0, "failed": 0, "started_at": None, "elapsed_sec": None}
+
+
+# дедлайн текущего запроса (time.monotonic()), выставляет _DeadlineMiddleware
+_deadline_var: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+# Accept-Encoding текущего запроса — какой вариант тела из кэша отдавать
+_accept_encoding_var: ContextVar[str] = ContextVar("accept_encoding", default="")
+_request_stats = {"client_disconnects": 0, "deadline_exceeded": 0}
+
+
+PUBLIC_PATHS = {"/", "/health", "/health/", "/docs", "/openapi.json", "/redoc", "/favicon.ico"}
+
+def _cache_key(*parts: Any) -> str:
+    return ":".join(str(p) for p in parts)
+
+
+def _encoding_weights(header: str) -> Dict[str, float]:
+    """Кодировка -> q из Accept-Encoding (q=0 — явный запрет)."""
+    out = {}
+    for part in header.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name.strip():
+            out[name.strip()] = q
+    return out
+
+def _accepts_encoding(weights: Dict[str, float], name: str) -> bool:
+    # явное "gzip;q=0" сильнее "*"
+    return weights.get(name, weights.get("*", 0.0)) > 0
+
+
+class _Codec:
+    """Сериализация значений кэша. format — формат байтов: он (с версией) идёт в префикс ключа."""
+
+    # поднять при несовместимом изменении того, что лежит под ключами
+    VERSION = 1
+
+    def __init__(self, name: str, fmt: str, dumps, loads):
+        self.name = name
+        self.format = fmt
+        self.dumps = dumps
+        self.loads = loads
+
+    @property
+    def prefix(self) -> str:
+        # JSON-кодеки пишут один и тот же JSON, поэтому делят префикс
+        return "%s%d" % (self.format, self.VERSION)
+
+
+def _json_dumps(data: Any) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+_CODECS = {"json": lambda: _Codec("json", "json", _json_dumps, json.loads)}
+if orjson is not None:
+    _CODECS["orjson"] = lambda: _Codec("orjson", "json", orjson.dumps, orjson.loads)
+if msgspec is not None:
+    _CODECS["msgspec"] = lambda: _Codec("msgspec", "json", msgspec.json.encode, msgspec.json.decode)
+if msgpack is not None:
+    _CODECS["msgpack"] = lambda: _Codec(
+        "msgpack", "msgpack",
+        lambda data: msgpack.packb(data, use_bin_type=True),
+        lambda raw: msgpack.unpackb(raw, raw=False),
+    )
+
+def _make_codec(name: str, json_only: bool = False) -> _Codec:
+    """Кодек по имени; если он не установлен (или не JSON там, где нужен JSON) — stdlib json."""
+    factory = _CODECS.get(name)
+    codec = factory() if factory is not None else None
+    if codec is None or (json_only and codec.format != "json"):
+        if name != "json":
+            logger.warning("Cache codec %r is not available here, using json", name)
+        codec = _CODECS["json"]()
+    return codec
+
+
+_codec = _make_codec(CACHE_CODEC, json_only=True)
+_internal_codec = _make_codec(CACHE_INTERNAL_CODEC)
+
+
+_UNSET = object()
+
+
+class _CacheEntry:
+    """
+    Значение в кэше: готовые байты (для ответов — JSON в UTF-8, отдаётся как есть),
+    их gzip/brotli и лениво разобранные данные.
+    """
+
+    __slots__ = ("raw", "gz", "br", "codec", "_data")
+
+    def __init__(self, raw: bytes, gz: Optional[bytes] = None, br: Optional[bytes] = None,
+                 data: Any = _UNSET, codec: Optional[_Codec] = None):
+        self.raw = raw
+        self.gz = gz
+        self.br = br
+        self.codec = codec or _codec
+        self._data = data
+
+    @classmethod
+    def from_data(cls, data: Any, codec: Optional[_Codec] = None) -> "_CacheEntry":
+        codec = codec or _codec
+        raw = codec.dumps(data)
+        gz = br = None
+        # сжатые варианты нужны только телам ответов
+        if codec.format == "json" and len(raw) >= CACHE_COMPRESS_MIN_BYTES:
+            gz = gzip.compress(raw, CACHE_GZIP_LEVEL)
+            if CACHE_BROTLI and brotli is not None:
+                br = brotli.compress(raw)
+        return cls(raw, gz, br, data, codec)
+
+    @property
+    def data(self) -> Any:
+        if self._data is _UNSET:
+            self._data = self.codec.loads(self.raw)
+        return self._data
+
+    @property
+    def size(self) -> int:
+        """Байты тела и вариантов; разобранные данные сюда не входят."""
+        return len(self.raw) + len(self.gz or b"") + len(self.br or b"")
+
+    def body_for(self, accept_encoding: str) -> tuple:
+        """(тело, Content-Encoding или None) по Accept-Encoding клиента."""
+        weights = _encoding_weights(accept_encoding)
+        if self.br is not None and "br" in weights and _accepts_encoding(weights, "br"):
+            return self.br, "br"
+        if self.gz is not None and _accepts_encoding(weights, "gzip"):
+            return self.gz, "gzip"
+        return self.raw, None
+
+
+class _L1Namespace:
+    """
+    LRU одного пространства ключей, ограниченный по байтам. Хранятся только байты (тело и его
+    сжатые варианты), а не разобранные объекты: те в 3–4 раза больше JSON, и лимит бы врал.
+    """
+
+    def __init__(self, limit_bytes: int):
+        self.limit = limit_bytes
+        self.bytes = 0
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()  # key -> ((raw, gz, br, codec), expires_at, size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key: str, prefix: Optional[str] = None) -> Optional[tuple]:
+        """
+        (_CacheEntry, остаток TTL в секундах) или None. Запись новая: разбор данных на ней в L1 не остаётся.
+        prefix: нужен формат кодека; запись в другом формате — промах, а не попадание.
+        """
+        item = self._items.get(key)
+        if item is None or prefix is not None and item[0][3].prefix != prefix:
+            self.misses += 1
+            return None
+        left = item[1] - time.monotonic()
+        if left <= 0:
+            self._drop(key)
+            self.expired += 1
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        raw, gz, br, codec = item[0]
+        return _CacheEntry(raw, gz, br, codec=codec), left
+
+    def set(self, key: str, entry: _CacheEntry, ttl: float):
+        self._drop(key)
+        # только байты: запись с промаха несёт весь разобранный ответ апстрима, а size его не считает
+        size = entry.size
+        if ttl <= 0 or size > self.limit:
+            return
+        self._items[key] = ((entry.raw, entry.gz, entry.br, entry.codec), time.monotonic() + ttl, size)
+        self.bytes += size
+        while self.bytes > self.limit:
+            old = next(iter(self._items))
+            self._drop(old)
+            self.evictions += 1
+
+    def _drop(self, key: str):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.bytes -= item[2]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._items),
+            "bytes": self.bytes,
+            "limit_bytes": self.limit,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
+
+
+class _L1Cache:
+    """
+    Кэш в памяти процесса перед Redis: горячие ключи (offers:active и т.п.) не ходят в Redis,
+    а ответы ручек отдаются готовыми байтами без разбора. Срок жизни записи — оставшийся TTL
+    ключа в Redis, так что L1 не отдаёт то, что в Redis уже истекло.
+    """
+
+    def __init__(self, limits_mb: Dict[str, float], default_mb: float):
+        self.limits_mb = limits_mb
+        self.default_mb = default_mb
+        self._ns: Dict[str, _L1Namespace] = {}
+
+    def _space(self, key: str) -> _L1Namespace:
+        name = key.split(":", 1)[0]
+        ns = self._ns.get(name)
+        if ns is None:
+            ns = self._ns[name] = _L1Namespace(int(self.limits_mb.get(name, self.default_mb) * 2**20))
+        return ns
+
+    def get(self, key: str, prefix: Optional[str] = None) -> Optional[tuple]:
+        return self._space(key).get(key, prefix)
+
+    def set(self, key: str, entry: _CacheEntry, ttl: float):
+        self._space(key).set(key, entry, ttl)
+
+    def delete(self, key: str):
+        self._space(key)._drop(key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {name: ns.stats() for name, ns in self._ns.items()}
+
+
+_l1 = _L1Cache(L1_CACHE_LIMITS, L1_CACHE_DEFAULT_MB) if L1_CACHE else None
+
+async def cache_get_value(key: str) -> Optional[Any]:
+    """Служебное значение (не тело ответа) — кодеком CACHE_INTERNAL_CODEC."""
+    hit = await cache_get_entry(key, _internal_codec)
+    return hit[0].data if hit is not None else None
+
+async def cache_set_value(key: str, data: Any, ttl: int, codec: Optional[_Codec] = None):
+    if not rds and _l1 is None:
+        return
+    codec = codec or _internal_codec
+    try:
+        entry = await asyncio.to_thread(_CacheEntry.from_data, data, codec)
+    except Exception:
+        return
+    await cache_set_entry(key, entry, ttl)
+
+def _variant_keys(key: str, codec: _Codec) -> tuple:
+    # в Redis ключ с префиксом формата кодека; сжатые варианты — соседние ключи
+    key = _cache_key(codec.prefix, key)
+    return key, _cache_key(key, "gz"), _cache_key(key, "br")
+
+async def cache_get_entry(key: str, codec: Optional[_Codec] = None, *, skip_l1: bool = False) -> Optional[tuple]:
+    """
+    (_CacheEntry, остаток TTL в секундах или None, если TTL неизвестен) или None.
+    skip_l1: читать сразу из Redis (L1 при этом обновляется прочитанным).
+    """
+    codec = codec or _codec
+    if _l1 is not None and not skip_l1:
+        hit = _l1.get(key, codec.prefix)
+        if hit is not None:
+            return hit
+    if not rds:
+        return None
+    try:
+        keys = _variant_keys(key, codec)
+        # тело, его варианты и остаток TTL одним походом: L1 живёт не дольше ключа в Redis
+        async with rds.pipeline(transaction=True) as pipe:
+            pipe.mget(*keys)
+            pipe.pttl(keys[0])
+            (raw, gz, br), pttl = await pipe.execute()
+        if not raw:
+            return None
+        entry = _CacheEntry(raw, gz, br, codec=codec)
+        left = pttl / 1000 if pttl and pttl > 0 else None
+        if _l1 is not None and left is not None:
+            _l1.set(key, entry, left)
+        return entry, left
+    except Exception:
+        return None
+
+async def cache_set_entry(key: str, entry: _CacheEntry, ttl: int):
+    if _l1 is not None:
+        _l1.set(key, entry, ttl)
+    if not rds:
+        return
+    try:
+        # MULTI/EXEC: параллельный MGET не должен увидеть новое тело рядом со старым gzip
+        async with rds.pipeline(transaction=True) as pipe:
+            for k, v in zip(_variant_keys(key, entry.codec), (entry.raw, entry.gz, entry.br)):
+                if v is not None:
+                    pipe.set(k, v, ex=ttl)
+                else:
+                    # вариант от прошлой версии значения отдавать нельзя
+                    pipe.delete(k)
+            await pipe.execute()
+    except Exception:
+        pass
+
+async def cache_delete(key: str, codec: Optional[_Codec] = None):
+    if _l1 is not None:
+        _l1.delete(key)
+    if not rds:
+        return
+    try:
+        await rds.delete(*_variant_keys(key, codec or _codec))
+    except Exception:
+        pass
+
+def _cache_enabled() -> bool:
+    """Есть куда положить ответ: Redis или хотя бы L1 в памяти процесса."""
+    return rds is not None or _l1 is not None
+
+async def cache_lock(key: str, ttl: int = 90) -> bool:
+    """Дешёвый распределённый lock в Redis (чтобы не строить одно и то же параллельно)."""
+    if not rds:
+        return True  # без Redis считаем, что lock получен
+    try:
+        return bool(await rds.set(key, "1", nx=True, ex=ttl))
+    except Exception:
+        return True
+
+async def cache_unlock(key: str):
+    if not rds:
+        return
+    try:
+        await rds.delete(key)
+    except Exception:
+        pass
+
+async def cache_notify(key: str):
+    """Будим тех, кто ждёт ключ в cache_wait (в том числе на других инстансах)."""
+    if not rds:
+        return
+    try:
+        await rds.publish(_cache_key("built", key), "1")
+    except Exception:
+        pass
+
+async def cache_wait(key: str, timeout: float) -> Optional[_CacheEntry]:
+    """
+    Ждём, пока держатель lock положит key в кэш (cache_notify), не дольше timeout.
+    _CacheEntry или None — не дождались или держатель закончил без результата.
+    """
+    if not rds or timeout <= 0:
+        return None
+    pubsub = rds.pubsub()
+    try:
+        await pubsub.subscribe(_cache_key("built", key))
+        # держатель мог успеть до подписки
+        hit = await cache_get_entry(key)
+        if hit is not None:
+            return hit[0]
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return None
+            msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=left)
+            if msg is not None:
+                hit = await cache_get_entry(key)
+                return hit[0] if hit is not None else None
+    except Exception as e:
+        # Redis недоступен — не крутимся в цикле ожидания вхолостую
+        logger.warning("cache_wait %s failed: %s", key, str(e))
+        await asyncio.sleep(min(timeout, 0.5))
+        return None
+    finally:
+        try:
+            await pubsub.reset()
+        except Exception:
+            pass
+
+class _BrowserState:
+    """
+    Сохранённое состояние браузера (cookies + localStorage) по прокси: cookies антибота
+    привязаны к выходному IP. Хранится в Redis с TTL, без Redis — в SESSION_STATE_FILE.
+    """
+
+    def __init__(self, ttl: int, save_every: float, path: str):
+        self.ttl = ttl
+        self.save_every = save_every
+        self.path = path
+        self._saved_at: Dict[Optional[str], float] = {}
+        self._file_lock = threading.Lock()
+        self._pending: set = set()
+        self.saves = 0
+        self.restores = 0
+        self.restore_failures = 0
+        self.invalidations = 0
+        self.last_invalidation: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and (rds is not None or bool(self.path))
+
+    @staticmethod
+    def _key(proxy: Optional[str]) -> str:
+        # в ключе не светим логин/пароль прокси
+        return _cache_key("browser_state", hashlib.sha1((proxy or "direct").encode()).hexdigest()[:16])
+
+    def due(self, proxy: Optional[str]) -> bool:
+        return self.enabled and time.monotonic() - self._saved_at.get(proxy, float("-inf")) >= self.save_every
+
+    def _read_file(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _update_file(self, key: str, entry: Optional[Dict[str, Any]]):
+        """Чтение-изменение-запись файла целиком (в потоке); entry=None — удалить ключ."""
+        with self._file_lock:
+            data = self._read_file()
+            if entry is not None:
+                data[key] = entry
+            elif data.pop(key, None) is None:
+                return
+            # у каждого воркера свой временный файл, иначе они пишут друг другу в середину
+            tmp = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+
+    def save_soon(self, api, proxy: Optional[str]):
+        """Снимок в фоне, уже после возврата сессии в пул: storage_state только читает контекст."""
+        self._saved_at[proxy] = time.monotonic()
+        task = asyncio.create_task(self.save(api, proxy))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def save(self, api, proxy: Optional[str]):
+        self._saved_at[proxy] = time.monotonic()
+        try:
+            state = await api.ctx.storage_state()
+        except Exception as e:
+            # сессию могли перезапустить, пока снимок ждал своей очереди
+            logger.warning("Browser state snapshot failed: %s", str(e))
+            return
+        entry = {"saved_at": time.time(), "state": state}
+        if rds is not None:
+            await cache_set_value(self._key(proxy), entry, self.ttl)
+        else:
+            await asyncio.to_thread(self._update_file, self._key(proxy), entry)
+        self.saves += 1
+
+    async def load(self, proxy: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        if rds is not None:
+            entry = await cache_get_value(self._key(proxy))
+        else:
+            entry = (await asyncio.to_thread(self._read_file)).get(self._key(proxy))
+        if not entry or time.time() - entry.get("saved_at", 0) > self.ttl:
+            return None
+        return entry.get("state")
+
+    async def invalidate(self, proxy: Optional[str], reason: str):
+        if not self.enabled:
+            return
+        self.invalidations += 1
+        self.last_invalidation = reason
+        self._saved_at.pop(proxy, None)
+        if rds is not None:
+            await cache_delete(self._key(proxy), _internal_codec)
+        else:
+            await asyncio.to_thread(self._update_file, self._key(proxy), None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "store": "redis" if rds is not None else ("file" if self.path else None),
+            "saves": self.saves,
+            "restores": self.restores,
+            "restore_failures": self.restore_failures,
+            "invalidations": self.invalidations,
+            "last_invalidation": self.last_invalidation,
+        }
+
+
+_browser_state = _BrowserState(SESSION_STATE_TTL_SEC, SESSION_STATE_SAVE_SEC, SESSION_STATE_FILE)
+
+async def _warmup_from_state(api, state: Dict[str, Any]):
+    """Как ChizhikAPI._warmup, но контекст браузера создаётся с сохранённым storage_state."""
+    from camoufox.async_api import AsyncCamoufox
+    from human_requests import HumanBrowser
+    from human_requests.abstraction import Proxy
+    br = await AsyncCamoufox(
+        headless=api.headless,
+        proxy=Proxy(api.proxy).as_dict() if api.proxy else None,
+        **api.browser_opts,
+    ).start()
+    api.session = HumanBrowser.replace(br)
+    api.ctx = await api.session.new_context(storage_state=state)
+    api.page = await api.ctx.new_page()
+    await api.page.goto(api.CATALOG_URL, wait_until="domcontentloaded")
+    # с живыми cookies JSON отдаётся сразу; иначе — состояние протухло
+    await api.page.wait_for_selector("pre", timeout=api.timeout_ms, state="attached")
+
+async def _launch_api(proxy: Optional[str] = PROXY):
+    """Запуск и прогрев нового ChizhikAPI (браузер Camoufox)."""
+    from chizhik_api import ChizhikAPI
+    state = await _browser_state.load(proxy)
+    if state is not None:
+        api = ChizhikAPI(proxy=proxy, headless=HEADLESS)
+        try:
+            await _warmup_from_state(api, state)
+            _browser_state.restores += 1
+            return api
+        except Exception as e:
+            logger.warning("Browser state restore failed, full warmup: %s", str(e))
+            await _close_api(api)
+            _browser_state.restore_failures += 1
+            await _browser_state.invalidate(proxy, "restore failed")
+    api = ChizhikAPI(proxy=proxy, headless=HEADLESS)
+    try:
+        await api.__aenter__()  # прогрев + запуск браузера
+    except Exception:
+        await _close_api(api)
+        raise
+    return api
+
+async def _close_api(api):
+    try:
+        await api.__aexit__(None, None, None)
+    except Exception:
+        pass
+
+
+def _api_root_pid(api) -> Optional[int]:
+    """PID драйвера playwright этого ChizhikAPI (браузер — его потомки). Внутренности playwright, поэтому мягко."""
+    session = getattr(api, "session", None)
+    # api.session — публичная обёртка playwright (HumanBrowser < Browser): соединение у её _impl_obj
+    for obj in (getattr(session, "_impl_obj", None), session):
+        try:
+            return obj._connection._transport._proc.pid
+        except Exception:
+            continue
+    return None
+
+def _tree_rss_mb(root_pid: int) -> Optional[float]:
+    """RSS процесса и всех его потомков по /proc (только Linux)."""
+    try:
+        children: Dict[int, list] = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open("/proc/%s/stat" % name) as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            ppid = int(stat.rsplit(")", 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(name))
+        page = os.sysconf("SC_PAGE_SIZE")
+        total, stack = 0, [root_pid]
+        while stack:
+            pid = stack.pop()
+            try:
+                with open("/proc/%d/statm" % pid) as f:
+                    total += int(f.read().split()[1]) * page
+            except OSError:
+                continue
+            stack.extend(children.get(pid, []))
+        return total / (1024 * 1024)
+    except Exception:
+        return None
+
+
+class _Session:
+    """Один ChizhikAPI (браузер) из пула + его состояние."""
+
+    def __init__(self, sid: int, proxy: Optional[str] = None):
+        self.id = sid
+        self.proxy = proxy
+        self.api = None
+        self.busy = False
+        self.calls = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.launches = 0
+        self.last_error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.api_calls = 0  # вызовов на текущем браузере
+        self.rss_mb: Optional[float] = None
+        self.rss_error: Optional[str] = None  # почему RSS не измерить (RECYCLE_MAX_RSS_MB тогда не работает)
+        self.recycling: Optional[str] = None
+        self.pending_api = None  # замена, поднятая заранее; подменяем при возврате в пул
+        self._launching: Optional[asyncio.Task] = None
+        self.recycle_after = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return self.consecutive_errors == 0
+
+    async def ensure(self):
+        """Поднимаем ChizhikAPI один раз и держим открытым."""
+        if self.api is not None:
+            return self.api
+        # прогрев и первый вызов могут прийти одновременно — браузер запускаем один
+        if self._launching is None:
+            self._launching = asyncio.create_task(_launch_api(self.proxy))
+        launching = self._launching
+        try:
+            api = await asyncio.shield(launching)
+        finally:
+            if self._launching is launching and launching.done():
+                self._launching = None
+        if self.api is None:
+            self._attach(api)
+        elif self.api is not api:
+            await _close_api(api)
+        return self.api
+
+    def _attach(self, api):
+        self.api = api
+        self.launches += 1
+        self.started_at = time.monotonic()
+        self.api_calls = 0
+        self.rss_mb = None
+
+    def recycle_reason(self) -> Optional[str]:
+        if self.api is None or self.recycling or time.monotonic() < self.recycle_after:
+            return None
+        if RECYCLE_MAX_CALLS and self.api_calls >= RECYCLE_MAX_CALLS:
+            return "calls"
+        if RECYCLE_MAX_AGE_MIN and time.monotonic() - self.started_at >= RECYCLE_MAX_AGE_MIN * 60:
+            return "age"
+        if RECYCLE_MAX_RSS_MB and self.rss_mb is not None and self.rss_mb >= RECYCLE_MAX_RSS_MB:
+            return "rss"
+        return None
+
+    def swap_pending(self):
+        """Подменить браузер на заранее поднятую замену (сессия не занята — ничего не оборвём)."""
+        api, self.pending_api = self.pending_api, None
+        if api is None:
+            return
+        old = self.api
+        self._attach(api)
+        self.recycling = None
+        if old is not None:
+            asyncio.create_task(_close_api(old))
+
+    async def reset(self):
+        api, self.api = self.api, None
+        self.started_at = None
+        if api is not None:
+            await _close_api(api)
+
+    def restart(self):
+        """
+        Заменить сломанный браузер. Есть горячий резерв — подменяем указатель сразу,
+        нет — следующий ensure() запустит браузер с нуля. Старый закрываем в фоне.
+        """
+        old, self.api = self.api, None
+        self.started_at = None
+        api, self.pending_api = self.pending_api, None
+        self.recycling = None
+        if api is None:
+            api = _standby.take(self.proxy)
+        if api is not None:
+            self._attach(api)
+        if old is not None:
+            asyncio.create_task(_close_api(old))
+
+    def mark_ok(self):
+        self.calls += 1
+        self.api_calls += 1
+        self.consecutive_errors = 0
+
+    def mark_error(self, e: Exception):
+        self.calls += 1
+        self.api_calls += 1
+        self.errors += 1
+        self.consecutive_errors += 1
+        self.last_error = str(e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "proxy": _proxy_label(self.proxy),
+            "started": self.api is not None,
+            "busy": self.busy,
+            "healthy": self.healthy,
+            "calls": self.calls,
+            "errors": self.errors,
+            "consecutive_errors": self.consecutive_errors,
+            "launches": self.launches,
+            "uptime_sec": round(time.monotonic() - self.started_at, 1) if self.started_at else None,
+            "api_calls": self.api_calls,
+            "rss_mb": round(self.rss_mb, 1) if self.rss_mb is not None else None,
+            "rss_error": self.rss_error,
+            "recycling": self.recycling,
+            "last_error": self.last_error,
+        }
+
+
+class _Standby:
+    """
+    Горячий резерв: CHIZHIK_STANDBY заранее запущенных и прогретых браузеров.
+    При падении сессии резерв подставляется мгновенно, новый строится в фоне.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._ready: list = []  # (proxy, api)
+        self._proxies = itertools.cycle(PROXIES)
+        self._building = 0
+        self.builds = 0
+        self.failures = 0
+        self.swaps = 0
+        self._closed = False
+
+    def take(self, proxy: Optional[str]):
+        """Резервный браузер для сессии с этим прокси (браузер привязан к прокси при запуске)."""
+        for i, (p, api) in enumerate(self._ready):
+            if p == proxy:
+                del self._ready[i]
+                self.swaps += 1
+                self.refill()
+                return api
+        return None
+
+    def refill(self):
+        # резерв строим по прокси по кругу: CHIZHIK_STANDBY >= числа прокси покрывает все
+        while not self._closed and len(self._ready) + self._building < self.size:
+            self._building += 1
+            asyncio.create_task(self._build(next(self._proxies)))
+
+    async def _build(self, proxy: Optional[str]):
+        try:
+            api = await _launch_api(proxy)
+        except Exception as e:
+            self.failures += 1
+            logger.error("Standby browser launch failed: %s", e)
+            # не долбим апстрим запусками, пока он лежит
+            await asyncio.sleep(STANDBY_RETRY_SEC)
+            self._building -= 1
+            self.refill()
+            return
+        self._building -= 1
+        self.builds += 1
+        if self._closed:
+            await _close_api(api)
+        else:
+            self._ready.append((proxy, api))
+
+    async def close(self):
+        self._closed = True
+        ready, self._ready = self._ready, []
+        await asyncio.gather(*(_close_api(a) for _, a in ready), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "ready": len(self._ready),
+            "building": self._building,
+            "builds": self.builds,
+            "failures": self.failures,
+            "swaps": self.swaps,
+        }
+
+
+_standby = _Standby(CHIZHIK_STANDBY)
+
+
+# Классы приоритета апстрим-вызовов: чем меньше ранг, тем раньше получает браузер.
+PRIORITY_CLASSES = {"interactive": 0, "prefetch": 1, "crawl": 2, "warmup": 3}
+
+
+class _Waiter:
+    __slots__ = ("fut", "cls", "rank", "t0")
+
+    def __init__(self, fut: asyncio.Future, cls: str):
+        self.fut = fut
+        self.cls = cls
+        self.rank = PRIORITY_CLASSES[cls]
+        self.t0 = time.monotonic()
+
+    def effective_rank(self, now: float) -> float:
+        # старение: каждые SCHED_AGING_SEC ожидания поднимают на один класс, фоновые не голодают
+        return self.rank - (now - self.t0) / SCHED_AGING_SEC
+
+
+class _ClassStats:
+    __slots__ = ("queued", "enqueued", "granted", "wait_sec_total", "wait_sec_max")
+
+    def __init__(self):
+        self.queued = 0
+        self.enqueued = 0
+        self.granted = 0
+        self.wait_sec_total = 0.0
+        self.wait_sec_max = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queued,
+            "enqueued": self.enqueued,
+            "granted": self.granted,
+            "avg_wait_ms": round(self.wait_sec_total / self.granted * 1000, 1) if self.granted else 0.0,
+            "max_wait_ms": round(self.wait_sec_max * 1000, 1),
+        }
+
+
+def _proxy_label(proxy: Optional[str]) -> Optional[str]:
+    """Прокси без логина/пароля — для логов и /health."""
+    if not proxy:
+        return None
+    return re.sub(r"//[^@/]*@", "//***@", proxy)
+
+
+class _ProxyStats:
+    """Здоровье одного прокси: EWMA доли ошибок и латентности (относительно p50 операции)."""
+
+    def __init__(self, proxy: Optional[str]):
+        self.proxy = proxy
+        self.calls = 0
+        self.errors = 0
+        self.samples = 0  # вызовов с последнего возвращения в строй
+        self.error_ewma = 0.0
+        self.latency_ewma: Optional[float] = None
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.last_eject_reason: Optional[str] = None
+
+    def ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def stats(self, outstanding: int, sessions: int) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "proxy": _proxy_label(self.proxy),
+            "sessions": sessions,
+            "outstanding": outstanding,
+            "calls": self.calls,
+            "errors": self.errors,
+            "error_rate": round(self.error_ewma, 3),
+            "latency_ratio": round(self.latency_ewma, 2) if self.latency_ewma is not None else None,
+            "ejected": self.ejected(now),
+            "ejected_for_sec": round(self.ejected_until - now, 1) if self.ejected(now) else None,
+            "ejections": self.ejections,
+            "last_eject_reason": self.last_eject_reason,
+        }
+
+
+class _ConcurrencyLimit:
+    """
+    AIMD-лимит одновременных вызовов:
+    - успешный вызов при полностью занятом лимите: +1/limit (около +1 за «окно» из limit вызовов)
+    - перегрузка (таймаут, антибот/429, 5xx, сеть) или медиана последних
+      CONCURRENCY_LATENCY_SAMPLES вызовов операции выше её p50 × CONCURRENCY_LATENCY_TOLERANCE:
+      limit × CONCURRENCY_BACKOFF (один медленный вызов из длинного хвоста — не перегрузка)
+    Уменьшаем не чаще раза на поколение: сигналы от вызовов, начатых до прошлого
+    уменьшения, уже учтены.
+    """
+
+    def __init__(self, lo: int, hi: int, adaptive: bool):
+        self.min = lo
+        self.max = hi
+        self.adaptive = adaptive
+        self.limit = float(hi)
+        self._decreased_at = 0.0
+        self._recent: Dict[str, deque] = {}
+        self.increases = 0
+        self.decreases = 0
+        self.last_decrease_reason: Optional[str] = None
+
+    def current(self) -> int:
+        return int(self.limit)
+
+    def on_success(self, started: float, op: Optional[str], sec: float, in_use: int) -> bool:
+        if not self.adaptive:
+            return False
+        if op and self._latency_overloaded(started, op, sec):
+            return False
+        if in_use < self.current() or self.limit >= self.max:
+            # лимит не упирается — расти не из чего
+            return False
+        before = self.current()
+        self.limit = min(float(self.max), self.limit + 1.0 / self.limit)
+        if self.current() > before:
+            self.increases += 1
+            return True
+        return False
+
+    def _latency_overloaded(self, started: float, op: str, sec: float) -> bool:
+        recent = self._recent.get(op)
+        if recent is None:
+            recent = self._recent[op] = deque(maxlen=CONCURRENCY_LATENCY_SAMPLES)
+        recent.append(sec)
+        p50 = _latency.percentile(op, 0.5)
+        if not p50 or len(recent) < recent.maxlen:
+            return False
+        median = sorted(recent)[len(recent) // 2]
+        if median <= p50 * CONCURRENCY_LATENCY_TOLERANCE:
+            return False
+        # следующий сигнал — по новым вызовам, уже при уменьшенном лимите
+        recent.clear()
+        self.on_overload(started, "median latency x%.1f of p50" % (median / p50))
+        return True
+
+    def on_overload(self, started: float, reason: str):
+        if not self.adaptive or started < self._decreased_at or self.limit <= self.min:
+            return
+        self.limit = max(float(self.min), self.limit * CONCURRENCY_BACKOFF)
+        self._decreased_at = time.monotonic()
+        self.decreases += 1
+        self.last_decrease_reason = reason
+        logger.warning("Upstream concurrency limit -> %d: %s", self.current(), reason)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "adaptive": self.adaptive,
+            "limit": self.current(),
+            "min": self.min,
+            "max": self.max,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "last_decrease_reason": self.last_decrease_reason,
+        }
+
+
+class _NoIdleSession(Exception):
+    """Свободного браузера нет, а ждать нельзя (acquire(wait=False))."""
+
+
+class _ApiPool:
+    """
+    Пул из N ChizhikAPI: сессию берём на один вызов (checkout) и возвращаем (checkin).
+    Независимые вызовы идут параллельно, каждый браузер занят максимум одним вызовом.
+    Очередь ожидающих — приоритетная (PRIORITY_CLASSES) со старением.
+    Сессии распределены по прокси; свободную берём у прокси с наименьшим числом
+    текущих вызовов, выкинутые (ejected) прокси пропускаем.
+    """
+
+    def __init__(self, size: int, proxies: list):
+        self.sessions = [_Session(i, proxies[i % len(proxies)]) for i in range(size)]
+        self.proxies = {p: _ProxyStats(p) for p in proxies}
+        self.limit = _ConcurrencyLimit(CONCURRENCY_MIN, min(CONCURRENCY_MAX, size), CONCURRENCY_ADAPTIVE)
+        self._idle = list(self.sessions)
+        self._waiters: list = []
+        self.checkouts = 0
+        self.classes = {c: _ClassStats() for c in PRIORITY_CLASSES}
+        self.recycled: Dict[str, int] = {}
+        self.service_sec = 0.0  # EWMA времени, на которое берут сессию
+        self.shed: Dict[str, int] = {}
+
+    def _outstanding(self) -> Dict[Optional[str], int]:
+        out: Dict[Optional[str], int] = {}
+        for x in self.sessions:
+            if x.busy:
+                out[x.proxy] = out.get(x.proxy, 0) + 1
+        return out
+
+    def in_use(self) -> int:
+        return sum(1 for x in self.sessions if x.busy)
+
+    def _pick_idle(self) -> Optional[_Session]:
+        if self.in_use() >= self.limit.current():
+            return None
+        now = time.monotonic()
+        candidates = [x for x in self._idle if not self.proxies[x.proxy].ejected(now)]
+        if not candidates:
+            return None
+        # наименее загруженный прокси, затем уже запущенные и здоровые браузеры
+        outstanding = self._outstanding()
+        s = min(candidates, key=lambda x: (outstanding.get(x.proxy, 0), x.api is None, x.consecutive_errors))
+        self._idle.remove(s)
+        return s
+
+    def _pick_waiter(self) -> _Waiter:
+        now = time.monotonic()
+        w = min(self._waiters, key=lambda x: (x.effective_rank(now), x.t0))
+        self._waiters.remove(w)
+        return w
+
+    def _dispatch(self):
+        while self._waiters:
+            s = self._pick_idle()
+            if s is None:
+                return
+            w = self._pick_waiter()
+            self.classes[w.cls].queued -= 1
+            if w.fut.done():
+                self._idle.append(s)
+                continue
+            s.busy = True
+            w.fut.set_result(s)
+
+    def has_idle(self) -> bool:
+        now = time.monotonic()
+        if self._waiters or self.in_use() >= self.limit.current():
+            return False
+        return any(not self.proxies[x.proxy].ejected(now) for x in self._idle)
+
+    async def acquire(self, priority: str = "interactive", wait: bool = True) -> _Session:
+        s = self._pick_idle() if not self._waiters else None
+        if s is None and not wait:
+            raise _NoIdleSession("no idle session")
+        st = self.classes[priority]
+        st.enqueued += 1
+        if s is not None:
+            wait = 0.0
+        else:
+            w = _Waiter(asyncio.get_running_loop().create_future(), priority)
+            self._waiters.append(w)
+            st.queued += 1
+            try:
+                s = await w.fut
+            except asyncio.CancelledError:
+                if w.fut.done() and not w.fut.cancelled():
+                    self.release(w.fut.result())
+                elif w in self._waiters:
+                    self._waiters.remove(w)
+                    st.queued -= 1
+                raise
+            wait = time.monotonic() - w.t0
+        s.busy = True
+        self.checkouts += 1
+        st.granted += 1
+        st.wait_sec_total += wait
+        st.wait_sec_max = max(st.wait_sec_max, wait)
+        return s
+
+    def release(self, s: _Session):
+        s.busy = False
+        s.swap_pending()
+        self._maybe_recycle(s)
+        self._idle.append(s)
+        self._dispatch()
+
+    def concurrency_sample(self, started: float, op: Optional[str], kind: Optional[str] = None):
+        """Сигнал для адаптивного лимита: kind=None — успех, иначе категория ошибки."""
+        if kind is None:
+            grew = self.limit.on_success(started, op, time.monotonic() - started, self.in_use())
+            if grew:
+                self._dispatch()
+        elif kind in ("timeout", "rate_limited", "anti_bot", "upstream_5xx", "network"):
+            self.limit.on_overload(started, kind)
+
+    def proxy_result(self, s: _Session, ok: bool, op: Optional[str] = None, sec: Optional[float] = None):
+        """Итог вызова через прокси сессии s; при деградации прокси выкидывается на время."""
+        ps = self.proxies[s.proxy]
+        ps.calls += 1
+        ps.samples += 1
+        ps.error_ewma = ps.error_ewma * 0.9 + (0.0 if ok else 1.0) * 0.1
+        if not ok:
+            ps.errors += 1
+        elif op and sec is not None:
+            p50 = _latency.percentile(op, 0.5)
+            if p50:
+                ratio = sec / p50
+                ps.latency_ewma = ratio if ps.latency_ewma is None else ps.latency_ewma * 0.9 + ratio * 0.1
+        self._check_eject(ps)
+
+    def _check_eject(self, ps: _ProxyStats):
+        now = time.monotonic()
+        if len(self.proxies) < 2 or ps.ejected(now) or ps.samples < PROXY_MIN_CALLS:
+            return
+        healthy = [p for p in self.proxies.values() if p is not ps and not p.ejected(now)]
+        if not healthy:
+            return
+        reason = None
+        if ps.error_ewma >= PROXY_EJECT_ERROR_RATE:
+            reason = "error rate %.2f" % ps.error_ewma
+        else:
+            others = sorted(p.latency_ewma for p in healthy if p.latency_ewma is not None)
+            if others and ps.latency_ewma is not None:
+                median = others[len(others) // 2]
+                if ps.latency_ewma > median * PROXY_EJECT_LATENCY_FACTOR:
+                    reason = "latency x%.1f of median" % (ps.latency_ewma / median)
+        if reason is None:
+            return
+        logger.warning("Ejecting proxy %s for %.0fs: %s", _proxy_label(ps.proxy), PROXY_EJECT_SEC, reason)
+        ps.ejected_until = now + PROXY_EJECT_SEC
+        ps.ejections += 1
+        ps.last_eject_reason = reason
+        asyncio.get_running_loop().call_later(PROXY_EJECT_SEC, self._readmit, ps)
+
+    def _readmit(self, ps: _ProxyStats):
+        # возвращаем с чистой статистикой, дальше решат новые вызовы
+        ps.samples = 0
+        ps.error_ewma = 0.0
+        ps.latency_ewma = None
+        self._dispatch()
+
+    def _maybe_recycle(self, s: _Session):
+        reason = s.recycle_reason()
+        if reason:
+            s.recycling = reason
+            asyncio.create_task(self._recycle(s, reason))
+
+    async def _recycle(self, s: _Session, reason: str):
+        """Сначала поднимаем замену, потом подменяем; текущие вызовы доезжают на старом браузере."""
+        logger.info("Recycling session %d (%s)", s.id, reason)
+        try:
+            api = _standby.take(s.proxy) or await _launch_api(s.proxy)
+        except Exception as e:
+            logger.error("Recycle launch failed [session %d]: %s", s.id, e)
+            s.recycling = None
+            s.recycle_after = time.monotonic() + STANDBY_RETRY_SEC
+            return
+        if s.recycling != reason or s.api is None:
+            # пока поднимали, сессию уже перезапустили из-за ошибки
+            await _close_api(api)
+            return
+        s.pending_api = api
+        self.recycled[reason] = self.recycled.get(reason, 0) + 1
+        if not s.busy:
+            s.swap_pending()
+
+    async def start_all(self) -> list:
+        """Параллельный запуск всех браузеров пула; возвращает ошибки запуска."""
+        results = await asyncio.gather(*(s.ensure() for s in self.sessions), return_exceptions=True)
+        return [r for r in results if isinstance(r, BaseException)]
+
+    async def monitor(self):
+        """Фоновая проверка возраста и RSS браузеров."""
+        if not (RECYCLE_MAX_AGE_MIN or RECYCLE_MAX_RSS_MB):
+            return
+        while True:
+            await asyncio.sleep(RECYCLE_CHECK_SEC)
+            for s in self.sessions:
+                if s.api is None:
+                    continue
+                if RECYCLE_MAX_RSS_MB:
+                    await self._measure_rss(s)
+                self._maybe_recycle(s)
+
+    async def _measure_rss(self, s: _Session):
+        pid = _api_root_pid(s.api)
+        rss = await asyncio.to_thread(_tree_rss_mb, pid) if pid else None
+        error = None
+        if pid is None:
+            error = "browser pid unknown"
+        elif rss is None:
+            error = "cannot read /proc for pid %d" % pid
+        if error and error != s.rss_error:
+            logger.warning("Session %d: RSS not measurable (%s), RECYCLE_MAX_RSS_MB ignored", s.id, error)
+        s.rss_mb = rss
+        s.rss_error = error
+
+    def queued(self) -> int:
+        """Все ждущие апстрима: очередь пула + очереди bulkhead'ов."""
+        return len(self._waiters) + sum(len(b._waiters) for b in _bulkheads.values())
+
+    def expected_wait(self) -> float:
+        """Оценка ожидания новой заявки: очередь / число сессий * среднее время обслуживания."""
+        queued = self.queued()
+        if self._idle and not queued and self.in_use() < self.limit.current():
+            return 0.0
+        return (queued + 1) / self.limit.current() * self.service_sec
+
+    def admit(self, priority: str):
+        """Не ставим в очередь то, что всё равно не дождётся: сразу UpstreamOverloaded (429)."""
+        reason = None
+        queued = self.queued()
+        wait = self.expected_wait()
+        if queued >= UPSTREAM_MAX_QUEUE:
+            reason = "queue_full"
+        elif wait > UPSTREAM_MAX_WAIT_SEC:
+            reason = "wait_too_long"
+        if reason is None:
+            return
+        key = "%s:%s" % (priority, reason)
+        self.shed[key] = self.shed.get(key, 0) + 1
+        raise UpstreamOverloaded(
+            "upstream overloaded (%s, queue %d)" % (reason, queued),
+            retry_after=max(1.0, wait),
+        )
+
+    @asynccontextmanager
+    async def session(self, priority: str = "interactive", wait: bool = True):
+        s = await self.acquire(priority, wait)
+        t0 = time.monotonic()
+        try:
+            yield s
+        finally:
+            took = time.monotonic() - t0
+            self.service_sec = took if not self.service_sec else self.service_sec * 0.9 + took * 0.1
+            self.release(s)
+
+    async def close(self):
+        if _direct is not None:
+            await _direct.close()
+        await _standby.close()
+        await asyncio.gather(*(s.reset() for s in self.sessions), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self.sessions),
+            "concurrency": self.limit.stats(),
+            "idle": len(self._idle),
+            "busy": sum(1 for s in self.sessions if s.busy),
+            "waiting": len(self._waiters),
+            "checkouts": self.checkouts,
+            "service_ms": round(self.service_sec * 1000, 1),
+            "expected_wait_ms": round(self.expected_wait() * 1000, 1),
+            "shed": dict(self.shed),
+            "calls": sum(s.calls for s in self.sessions),
+            "errors": sum(s.errors for s in self.sessions),
+            "queues": {c: st.as_dict() for c, st in self.classes.items()},
+            "standby": _standby.stats(),
+            "recycled": dict(self.recycled),
+            "proxies": [
+                ps.stats(
+                    self._outstanding().get(p, 0),
+                    sum(1 for x in self.sessions if x.proxy == p),
+                )
+                for p, ps in self.proxies.items()
+            ],
+            "sessions": [s.stats() for s in self.sessions],
+        }
+
+
+_pool = _ApiPool(CHIZHIK_POOL_SIZE, PROXIES)
+
+
+class UpstreamError(Exception):
+    """Ошибка апстрима (в т.ч. пришедшая из брокера)."""
+
+    def __init__(self, msg: str = "", retry_after: Optional[float] = None):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+class UpstreamHTTPError(UpstreamError):
+    """Апстрим ответил HTTP-ошибкой."""
+
+    def __init__(self, msg: str = "", retry_after: Optional[float] = None, status: int = 0):
+        super().__init__(msg, retry_after=retry_after)
+        self.status = status
+
+
+class UpstreamUnavailable(UpstreamError):
+    """Circuit breaker открыт: в апстрим не ходим, отвечаем сразу."""
+
+
+class DeadlineExceeded(UpstreamError):
+    """Бюджет запроса исчерпан раньше, чем пришёл ответ апстрима."""
+
+
+class UpstreamOverloaded(UpstreamError):
+    """Очередь к апстриму переполнена: отвечаем 429 сразу, а не после долгого ожидания."""
+
+
+class _CircuitBreaker:
+    """
+    closed -> open: BREAKER_FAILURES ошибок подряд или доля ошибок >= BREAKER_FAILURE_RATE
+                    в окне последних BREAKER_WINDOW вызовов (не меньше BREAKER_MIN_CALLS)
+    open -> half_open: через BREAKER_OPEN_SEC пропускаем ровно один пробный вызов
+    half_open -> closed/open: по результату пробы
+    """
+
+    def __init__(self):
+        self.state = "closed"
+        self.window: "deque[bool]" = deque(maxlen=BREAKER_WINDOW)
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.rejected = 0
+        self.transitions: "deque[Dict[str, Any]]" = deque(maxlen=20)
+
+    def _set(self, state: str, reason: str):
+        if state == self.state:
+            return
+        logger.warning("Circuit breaker %s -> %s (%s)", self.state, state, reason)
+        self.transitions.append({"at": round(time.time(), 3), "from": self.state, "to": state, "reason": reason})
+        self.state = state
+        if state == "open":
+            self.opened_at = time.monotonic()
+        elif state == "closed":
+            self.window.clear()
+            self.consecutive_failures = 0
+
+    def retry_after(self) -> float:
+        return max(1.0, BREAKER_OPEN_SEC - (time.monotonic() - self.opened_at))
+
+    def before_call(self) -> bool:
+        """Разрешён ли вызов. Возвращает True, если это пробный (half-open) вызов."""
+        if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_OPEN_SEC:
+            self._set("half_open", "cooldown elapsed")
+        if self.state == "closed":
+            return False
+        if self.state == "half_open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        self.rejected += 1
+        raise UpstreamUnavailable("circuit breaker is %s" % self.state, retry_after=self.retry_after())
+
+    def after_call(self, ok: Optional[bool], probe: bool):
+        """ok=None — вызов отменён (клиент ушёл), результат не учитываем."""
+        if probe:
+            self.probe_in_flight = False
+        if ok is None:
+            return
+        if probe:
+            self._set("closed" if ok else "open", "probe %s" % ("succeeded" if ok else "failed"))
+            return
+        self.window.append(ok)
+        self.consecutive_failures = 0 if ok else self.consecutive_failures + 1
+        if self.state != "closed" or ok:
+            return
+        failures = self.window.count(False)
+        if self.consecutive_failures >= BREAKER_FAILURES:
+            self._set("open", "%d consecutive failures" % self.consecutive_failures)
+        elif len(self.window) >= BREAKER_MIN_CALLS and failures / len(self.window) >= BREAKER_FAILURE_RATE:
+            self._set("open", "failure rate %d/%d" % (failures, len(self.window)))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "window_failures": self.window.count(False),
+            "window_calls": len(self.window),
+            "rejected": self.rejected,
+            "retry_after_sec": round(self.retry_after(), 1) if self.state == "open" else None,
+            "transitions": list(self.transitions),
+        }
+
+
+_breaker = _CircuitBreaker()
+
+
+class _LatencyTracker:
+    """Скользящее окно длительностей вызовов по операциям -> перцентили и таймауты."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._samples: Dict[str, "deque[float]"] = {}
+        self.timeouts: Dict[str, int] = {}
+
+    def observe(self, op: str, sec: float):
+        self._samples.setdefault(op, deque(maxlen=self.size)).append(sec)
+
+    def note_timeout(self, op: str):
+        self.timeouts[op] = self.timeouts.get(op, 0) + 1
+
+    def percentile(self, op: str, q: float) -> Optional[float]:
+        samples = self._samples.get(op)
+        if not samples or len(samples) < TIMEOUT_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def timeout_for(self, op: Optional[str]) -> float:
+        if op in TIMEOUT_OVERRIDES:
+            return TIMEOUT_OVERRIDES[op]
+        p99 = self.percentile(op, 0.99) if op else None
+        if p99 is None:
+            return float(CHIZHIK_TIMEOUT_SEC)
+        return min(TIMEOUT_CEIL_SEC, max(TIMEOUT_FLOOR_SEC, p99 * TIMEOUT_P99_FACTOR))
+
+    def stats(self) -> Dict[str, Any]:
+        out = {}
+        for op in set(self._samples) | set(self.timeouts):
+            samples = self._samples.get(op, ())
+            pct = {q: self.percentile(op, v) for q, v in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))}
+            out[op] = {
+                "samples": len(samples),
+                **{q: round(v * 1000, 1) if v is not None else None for q, v in pct.items()},
+                "timeout_sec": round(self.timeout_for(op), 2),
+                "timeouts": self.timeouts.get(op, 0),
+            }
+        return out
+
+
+_latency = _LatencyTracker(TIMEOUT_WINDOW)
+
+async def _timed(fn, api, op: Optional[str]):
+    """Вызов с таймаутом по операции; длительность (и срабатывания таймаута) идут в статистику."""
+    timeout = _latency.timeout_for(op)
+    t0 = time.monotonic()
+    try:
+        data = await asyncio.wait_for(fn(api), timeout=timeout)
+    except asyncio.TimeoutError:
+        if op:
+            # в окно замеров не кладём: иначе p99 × factor раскручивает таймаут до потолка
+            _latency.note_timeout(op)
+        raise asyncio.TimeoutError("%s timed out after %.1fs" % (op or "upstream call", timeout))
+    if op:
+        _latency.observe(op, time.monotonic() - t0)
+    return data
+
+# Категории ошибок апстрима и что с ними делать:
+#   retry     — повтор на той же сессии с экспоненциальной паузой и джиттером
+#   fail      — сразу отдаём ошибку (браузер исправен, ответ окончательный)
+#   backoff   — 429: пауза по Retry-After (или экспоненциальная) и повтор на той же сессии,
+#               cookies и страницу не трогаем; пауза длиннее RETRY_MAX_BACKOFF_MS — сразу ошибка
+#   challenge — заново проходим антибот-страницу в том же браузере, не вышло — рестарт
+#   restart   — перезапуск сессии (горячий резерв, если есть) и ещё одна попытка
+_ERROR_POLICY = {
+    "network": "retry",
+    "upstream_5xx": "retry",
+    "upstream_4xx": "fail",
+    "rate_limited": "backoff",
+    "anti_bot": "challenge",
+    "timeout": "restart",
+    "browser_crash": "restart",
+    "unknown": "restart",
+}
+_error_stats = {k: {"errors": 0, "retries": 0, "challenges": 0, "restarts": 0} for k in _ERROR_POLICY}
+
+_CRASH_MARKERS = ("target closed", "has been closed", "browser closed", "connection closed", "crashed")
+_NETWORK_MARKERS = ("fetch failed", "net::", "ns_error", "networkerror", "connection reset", "econnreset", "proxy")
+
+def _classify_error(e: Exception) -> str:
+    if isinstance(e, UpstreamHTTPError):
+        if e.status == 429:
+            return "rate_limited"
+        if e.status in (401, 403):
+            return "anti_bot"
+        return "upstream_4xx" if e.status < 500 else "upstream_5xx"
+    if isinstance(e, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(e, (ValueError, AssertionError)):
+        # вместо JSON пришла HTML-страница — почти всегда антибот
+        return "anti_bot"
+    msg = str(e).lower()
+    if type(e).__name__ == "TargetClosedError" or any(m in msg for m in _CRASH_MARKERS):
+        return "browser_crash"
+    if isinstance(e, (ConnectionError, OSError)) or any(m in msg for m in _NETWORK_MARKERS):
+        return "network"
+    return "unknown"
+
+def _retry_backoff(attempt: int) -> float:
+    base = RETRY_BASE_MS / 1000 * (2 ** (attempt - 1))
+    return min(RETRY_MAX_BACKOFF_MS / 1000, base) * random.uniform(0.5, 1.5)
+
+async def _resolve_challenge(api):
+    """Пройти антибот-страницу заново на том же браузере (как прогрев ChizhikAPI, без нового запуска)."""
+    await api.page.goto(api.CATALOG_URL, wait_until="networkidle")
+    await api.page.wait_for_selector("pre", timeout=api.timeout_ms, state="attached")
+
+async def _call_session(fn, *, op: Optional[str], priority: str, retry_restart: bool, wait: bool = True, on_checkout=None):
+    snapshot = None
+    async with _pool.session(priority, wait) as s:
+        if on_checkout is not None:
+            on_checkout(s)
+        attempt = 0
+        challenged = restarted = False
+        while True:
+            api = None
+            t0 = time.monotonic()
+            try:
+                api = await s.ensure()
+                t0 = time.monotonic()
+                data = await _timed(fn, api, op)
+                s.mark_ok()
+                _pool.proxy_result(s, True, op, time.monotonic() - t0)
+                _pool.concurrency_sample(t0, op)
+                if _direct is not None and _direct.needs_creds():
+                    await _direct.harvest(api, s.proxy)
+                if _browser_state.due(s.proxy):
+                    snapshot = api
+                break
+            except Exception as e:
+                kind = _classify_error(e)
+                policy = _ERROR_POLICY[kind]
+                st = _error_stats[kind]
+                st["errors"] += 1
+                if policy == "fail":
+                    s.mark_ok()
+                    raise
+                s.mark_error(e)
+                _pool.proxy_result(s, False)
+                _pool.concurrency_sample(t0, op, kind)
+                logger.error("Upstream error [session %d, %s]: %s", s.id, kind, str(e))
+
+                if policy == "retry" and attempt < RETRY_MAX:
+                    attempt += 1
+                    st["retries"] += 1
+                    await asyncio.sleep(_retry_backoff(attempt))
+                    continue
+                if policy == "backoff" and attempt < RETRY_MAX:
+                    pause = getattr(e, "retry_after", None) or _retry_backoff(attempt + 1)
+                    if pause <= RETRY_MAX_BACKOFF_MS / 1000:
+                        attempt += 1
+                        st["retries"] += 1
+                        await asyncio.sleep(pause)
+                        continue
+                if policy == "challenge" and not challenged and api is not None:
+                    challenged = True
+                    st["challenges"] += 1
+                    if _direct is not None:
+                        _direct.invalidate("challenge")
+                    await _browser_state.invalidate(s.proxy, "challenge")
+                    try:
+                        await _resolve_challenge(api)
+                        continue
+                    except Exception as e2:
+                        logger.error("Challenge re-solve failed [session %d]: %s", s.id, str(e2))
+                        policy = "restart"
+                if policy == "restart" and retry_restart and not restarted:
+                    restarted = True
+                    st["restarts"] += 1
+                    s.restart()
+                    continue
+                raise
+    if snapshot is not None:
+        # не держим сессию, пока снимается состояние браузера
+        _browser_state.save_soon(snapshot, s.proxy)
+    return data
+
+# операция -> семейство ручек (bulkhead)
+_OP_FAMILY = {
+    "geo_cities": "geo",
+    "offers_active": "offers",
+    "catalog_tree": "tree",
+    "catalog_products": "products",
+    "product_info": "product_info",
+    "product_info_batch": "product_info",
+}
+
+
+class _Bulkhead:
+    """Ограничение одновременных вызовов семейства + своя приоритетная очередь."""
+
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters: list = []
+        self.granted = 0
+        self.rejected = 0
+        self.wait_sec_total = 0.0
+
+    async def acquire(self, priority: str, op: Optional[str] = None):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.granted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise UpstreamOverloaded(
+                "bulkhead %s is full (queue %d)" % (self.name, len(self._waiters)),
+                retry_after=self.expected_wait(op),
+            )
+        w = _Waiter(asyncio.get_running_loop().create_future(), priority)
+        self._waiters.append(w)
+        try:
+            await w.fut
+        except asyncio.CancelledError:
+            if w.fut.done() and not w.fut.cancelled():
+                self.release()
+            elif w in self._waiters:
+                self._waiters.remove(w)
+            raise
+        self.granted += 1
+        self.wait_sec_total += time.monotonic() - w.t0
+
+    def expected_wait(self, op: Optional[str]) -> float:
+        """Когда очередь семейства разойдётся: (очередь / limit + 1) × p50 операции, не меньше секунды."""
+        p50 = (_latency.percentile(op, 0.5) if op else None) or 1.0
+        return max(1.0, (len(self._waiters) / self.limit + 1) * p50)
+
+    def try_acquire(self) -> bool:
+        """Слот без ожидания: False, если семейство занято или есть очередь."""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.granted += 1
+            return True
+        return False
+
+    def release(self):
+        now = time.monotonic()
+        while self._waiters:
+            w = min(self._waiters, key=lambda x: (x.effective_rank(now), x.t0))
+            self._waiters.remove(w)
+            if not w.fut.done():
+                # слот переходит ждущему, active не меняется
+                w.fut.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: str, op: Optional[str] = None):
+        await self.acquire(priority, op)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queued": len(self._waiters),
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.wait_sec_total / self.granted * 1000, 1) if self.granted else 0.0,
+        }
+
+
+_bulkheads = {
+    name: _Bulkhead(name, *BULKHEADS.get(name, (BULKHEAD_DEFAULT_LIMIT, BULKHEAD_DEFAULT_QUEUE)))
+    for name in sorted(set(_OP_FAMILY.values()))
+}
+if HEDGE_BUDGET > 0 and CHIZHIK_POOL_SIZE >= 2:
+    for _b in _bulkheads.values():
+        if _b.limit < 2:
+            logger.warning("HEDGE_BUDGET: bulkhead %s has limit %d, its calls are never hedged", _b.name, _b.limit)
+
+async def _call_chizhik(fn, *, op: Optional[str] = None, priority: str = "interactive", retry_restart: bool = True):
+    """
+    Все вызовы к chizhik_api через пул сессий:
+    - admission control: при переполненной очереди сразу UpstreamOverloaded
+    - bulkhead семейства операции: тяжёлые ручки не занимают все браузеры. Слот берётся до
+      очереди за браузером, а не после: иначе выданный браузер простаивал бы, пока вызов ждёт
+      слот. Цена — фоновый вызов, ждущий браузер, держит слот семейства; очередь bulkhead'а
+      поэтому тоже приоритетная, и interactive обгоняет фоновые ещё на входе в семейство
+    - circuit breaker: когда апстрим лежит, сразу UpstreamUnavailable без ожидания таймаутов
+    - браузеров не больше CHIZHIK_POOL_SIZE, каждый занят одним вызовом
+    - очередь за браузером по priority (interactive впереди фоновых)
+    - таймаут по операции op из наблюдаемой латентности (см. _LatencyTracker)
+    - ошибки классифицируются (_ERROR_POLICY): повтор, отказ, челлендж или рестарт сессии
+    """
+    _pool.admit(priority)
+    bulkhead = _bulkheads.get(_OP_FAMILY.get(op))
+    if bulkhead is None:
+        return await _call_guarded(fn, op=op, priority=priority, retry_restart=retry_restart)
+    async with bulkhead.slot(priority, op):
+        return await _call_guarded(fn, op=op, priority=priority, retry_restart=retry_restart)
+
+async def _call_guarded(fn, *, op: Optional[str], priority: str, retry_restart: bool):
+    probe = _breaker.before_call()
+    ok = None
+    try:
+        data = await _hedger.call(fn, op=op, priority=priority, retry_restart=retry_restart)
+        ok = True
+        return data
+    except Exception as e:
+        # 4xx — апстрим жив и ответил, для breaker это не сбой
+        ok = _classify_error(e) == "upstream_4xx"
+        raise
+    finally:
+        _breaker.after_call(ok, probe)
+
+# все операции chizhik — чтение (GET), повторить их на другом браузере безопасно
+_READ_ONLY_OPS = frozenset(_OP_FAMILY)
+
+
+class _Hedger:
+    """
+    Hedged requests: зависший вызов дублируется на второй свободный браузер после
+    p95 латентности операции, побеждает первый ответ, проигравший отменяется.
+    Бюджет — token bucket: каждый вызов добавляет HEDGE_BUDGET жетона, дубль стоит один.
+    """
+
+    MAX_TOKENS = 10.0
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.tokens = 0.0
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.no_budget = 0
+        self.no_idle = 0
+        self.no_slot = 0
+
+    def delay_for(self, op: Optional[str], priority: str) -> Optional[float]:
+        if self.budget <= 0 or priority != "interactive" or op not in _READ_ONLY_OPS or len(_pool.sessions) < 2:
+            return None
+        return _latency.percentile(op, HEDGE_QUANTILE)
+
+    async def call(self, fn, *, op: Optional[str], priority: str, retry_restart: bool):
+        delay = self.delay_for(op, priority)
+        if delay is None:
+            return await _call_session(fn, op=op, priority=priority, retry_restart=retry_restart)
+        self.calls += 1
+        self.tokens = min(self.MAX_TOKENS, self.tokens + self.budget)
+        primary = asyncio.ensure_future(_call_session(fn, op=op, priority=priority, retry_restart=retry_restart))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                return primary.result()
+            if self.tokens < 1:
+                self.no_budget += 1
+                return await primary
+            if not _pool.has_idle():
+                self.no_idle += 1
+                return await primary
+            # дубль — ещё один браузер семейства: в его bulkhead он тоже должен поместиться
+            bulkhead = _bulkheads.get(_OP_FAMILY.get(op))
+            if bulkhead is not None and not bulkhead.try_acquire():
+                self.no_slot += 1
+                return await primary
+            # дубль не ждёт в очереди и не перезапускает браузер — это забота основного вызова
+            hedge = asyncio.ensure_future(
+                _call_session(fn, op=op, priority=priority, retry_restart=False, wait=False, on_checkout=self._charge)
+            )
+            if bulkhead is not None:
+                # callback, а не finally: задачу могут отменить до того, как она начнётся
+                hedge.add_done_callback(lambda _t: bulkhead.release())
+            return await self._race(primary, hedge)
+        finally:
+            primary.cancel()
+
+    def _charge(self, _session):
+        # жетон и счётчик — только когда дубль получил браузер (его могли успеть забрать)
+        self.tokens -= 1
+        self.hedged += 1
+
+    async def _race(self, primary: "asyncio.Future", hedge: "asyncio.Future"):
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if hedge in done and isinstance(hedge.exception(), _NoIdleSession):
+                    self.no_idle += 1
+                ok = [t for t in done if t.exception() is None]
+                if ok:
+                    if ok[0] is hedge:
+                        self.hedge_wins += 1
+                    return ok[0].result()
+            # упали оба — отдаём ошибку основного вызова
+            return primary.result()
+        finally:
+            for t in pending:
+                t.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "budget": self.budget,
+            "tokens": round(self.tokens, 2),
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "skipped_no_budget": self.no_budget,
+            "skipped_no_idle": self.no_idle,
+            "skipped_no_slot": self.no_slot,
+        }
+
+
+_hedger = _Hedger(HEDGE_BUDGET)
+
+# -------- UPSTREAM OPS --------
+# Именованные операции: по имени их можно вызвать и локально, и через брокер.
+
+def _retry_after_sec(headers) -> Optional[float]:
+    """Retry-After ответа в секундах (число или HTTP-дата); None, если его нет или он кривой."""
+    value = (headers.get("retry-after") or headers.get("Retry-After")) if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _json(r):
+    """JSON из ответа chizhik_api; HTTP-ошибку поднимаем как UpstreamHTTPError (для классификации)."""
+    status = getattr(r, "status_code", None)
+    if isinstance(status, int) and status >= 400:
+        raise UpstreamHTTPError(
+            "HTTP %d: %s" % (status, getattr(r, "text", "")[:200]),
+            retry_after=_retry_after_sec(getattr(r, "headers", None)),
+            status=status,
+        )
+    return r.json()
+
+async def _op_geo_cities(api, search: str, page: int = 1):
+    r = await api.Geolocation.cities_list(search_name=search, page=page)
+    return _json(r)
+
+async def _op_offers_active(api):
+    r = await api.Advertising.active_inout()
+    return _json(r)
+
+async def _op_catalog_tree(api, city_id: str):
+    r = await api.Catalog.tree(city_id=city_id)
+    return _json(r)
+
+async def _op_catalog_products(api, city_id: str, page: int = 1, category_id: Optional[int] = None, search: Optional[str] = None):
+    r = await api.Catalog.products_list(
+        page=page,
+        category_id=category_id,
+        city_id=city_id,
+        search=search,
+    )
+    return _json(r)
+
+async def _op_product_info(api, product_id: int, city_id: Optional[str] = None):
+    r = await api.Catalog.Product.info(product_id=product_id, city_id=city_id)
+    return _json(r)
 
-TTL_GEO_SEC = int(os.getenv("TTL_GEO_SEC", str(24 * 60 * 60)))
-TTL_OFFERS_SEC = int(os.getenv("TTL_OFFERS_SEC", str(10 * 60)))
-TTL_TREE_SEC = int(os.getenv("TTL_TREE_SEC", str(24 * 60 * 60)))
-TTL_PRODUCTS_SEC = int(os.getenv("TTL_PRODUCTS_SEC", str(5 * 60)))
-TTL_PRODUCT_INFO_SEC = int(os.getenv("TTL_PRODUCT_INFO_SEC", str(60 * 60)))
+_UPSTREAM_OPS = {
+    "geo_cities": _op_geo_cities,
+    "offers_active": _op_offers_active,
+    "catalog_tree": _op_catalog_tree,
+    "catalog_products": _op_catalog_products,
+    "product_info": _op_product_info,
+}
 
-# Redis
-rds = None
-try:
-    import redis.asyncio as redis
-except Exception:
-    redis = None
+# -------- DIRECT HTTP --------
+# Те же запросы, что делает chizhik_api через page.fetch, но пулом httpx с cookies браузера.
 
-# Один "живой" ChizhikAPI на всё приложение
-_api = None
-_api_lock = asyncio.Lock()
-_warmup_state = {"status": "starting", "error": None}
+def _direct_route(op: str, params: Dict[str, Any]):
+    if op == "geo_cities":
+        return "/geo/cities/", {"name": params["search"], "page": params.get("page", 1)}
+    if op == "offers_active":
+        return "/catalog/unauthorized/active_inout/", {}
+    if op == "catalog_tree":
+        return "/catalog/unauthorized/categories/", {"city_id": params.get("city_id")}
+    if op == "catalog_products":
+        return "/catalog/unauthorized/products/", {
+            "page": params.get("page", 1),
+            "category_id": params.get("category_id"),
+            "city_id": params.get("city_id"),
+            "term": params.get("search"),
+        }
+    if op == "product_info":
+        return "/catalog/unauthorized/products/%s/" % params["product_id"], {"city_id": params.get("city_id")}
+    return None
 
 
-PUBLIC_PATHS = {"/", "/health", "/health/", "/docs", "/openapi.json", "/redoc", "/favicon.ico"}
+class _DirectUnavailable(Exception):
+    """Прямой путь не сработал (нет/протухли cookies, челлендж, 5xx) — идём через браузер."""
 
-def _cache_key(*parts: Any) -> str:
-    return ":".join(str(p) for p in parts)
 
-async def cache_get_json(key: str) -> Optional[Any]:
-    if not rds:
-        return None
-    try:
-        v = await rds.get(key)
-        if not v:
-            return None
-        return json.loads(v)
-    except Exception:
-        return None
+class _DirectClient:
+    """
+    Быстрый путь для JSON-ручек: cookies и User-Agent снимаются с живой сессии ChizhikAPI,
+    дальше запросы идут через httpx с keep-alive. Браузер снова нужен, только когда
+    cookies устарели (DIRECT_CREDS_TTL_SEC) или апстрим вернул челлендж.
+    """
 
-async def cache_set_json(key: str, data: Any, ttl: int):
-    if not rds:
-        return
-    try:
-        await rds.set(key, json.dumps(data, ensure_ascii=False), ex=ttl)
-    except Exception:
-        pass
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self._client = None
+        self._proxy: Optional[str] = PROXY
+        self._headers: Optional[Dict[str, str]] = None
+        self._harvested_at = 0.0
+        self.harvests = 0
+        self.calls = 0
+        self.fallbacks: Dict[str, int] = {}
 
-async def cache_lock(key: str, ttl: int = 90) -> bool:
-    """Дешёвый распределённый lock в Redis (чтобы не строить одно и то же параллельно)."""
-    if not rds:
-        return True  # без Redis считаем, что lock получен
-    try:
-        return bool(await rds.set(key, "1", nx=True, ex=ttl))
-    except Exception:
-        return True
+    def needs_creds(self) -> bool:
+        return self._headers is None or time.monotonic() - self._harvested_at > DIRECT_CREDS_TTL_SEC
 
-async def cache_unlock(key: str):
-    if not rds:
-        return
-    try:
-        await rds.delete(key)
-    except Exception:
-        pass
+    def ready(self, op: str, params: Dict[str, Any]) -> bool:
+        """Есть маршрут и живые cookies — прямой вызов имеет смысл пробовать."""
+        return _direct_route(op, params) is not None and not self.needs_creds()
 
-async def _ensure_api():
-    """Поднимаем ChizhikAPI один раз и держим открытым."""
-    global _api
-    if _api is not None:
-        return _api
+    def invalidate(self, reason: str):
+        self._headers = None
+        self.fallbacks[reason] = self.fallbacks.get(reason, 0) + 1
 
-    from chizhik_api import ChizhikAPI
-    _api = ChizhikAPI(proxy=PROXY, headless=HEADLESS)
-    await _api.__aenter__()  # прогрев + запуск браузера
-    return _api
+    async def harvest(self, api, proxy: Optional[str] = PROXY):
+        """Снять cookies и User-Agent с сессии браузера (вызывается, пока сессия у нас)."""
+        try:
+            cookies = await api.ctx.cookies()
+            user_agent = await api.page.evaluate("navigator.userAgent")
+        except Exception as e:
+            logger.warning("Direct HTTP: cannot harvest credentials: %s", e)
+            return
+        self._headers = {
+            "Accept": "application/json, text/plain, */*",
+            "User-Agent": user_agent,
+            "Origin": DIRECT_ORIGIN,
+            "Referer": DIRECT_ORIGIN + "/",
+            "Cookie": "; ".join("%s=%s" % (c["name"], c["value"]) for c in cookies),
+        }
+        self._harvested_at = time.monotonic()
+        self.harvests += 1
+        if proxy != self._proxy:
+            # cookies привязаны к выходному IP — ходим через тот же прокси
+            self._proxy = proxy
+            client, self._client = self._client, None
+            if client is not None:
+                asyncio.create_task(client.aclose())
 
-async def _reset_api():
-    global _api
-    if _api is None:
-        return
-    try:
-        await _api.__aexit__(None, None, None)
-    except Exception:
-        pass
-    _api = None
+    def _http(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                proxy=self._proxy,
+                limits=httpx.Limits(max_connections=DIRECT_MAX_CONNECTIONS, max_keepalive_connections=DIRECT_MAX_CONNECTIONS),
+            )
+        return self._client
+
+    async def call(self, op: str, params: Dict[str, Any]):
+        route = _direct_route(op, params)
+        if route is None:
+            raise _DirectUnavailable("no direct route for %s" % op)
+        if self.needs_creds():
+            self.fallbacks["no_creds"] = self.fallbacks.get("no_creds", 0) + 1
+            raise _DirectUnavailable("no credentials")
+        path, query = route
+        query = {k: v for k, v in query.items() if v is not None and v != ""}
+        key = op + ":direct"
+        timeout = _latency.timeout_for(key)
+        t0 = time.monotonic()
+        try:
+            r = await self._http().get(path, params=query, headers=self._headers, timeout=timeout)
+        except Exception as e:
+            self.fallbacks["network"] = self.fallbacks.get("network", 0) + 1
+            raise _DirectUnavailable(str(e) or type(e).__name__)
+        _latency.observe(key, time.monotonic() - t0)
+
+        if r.status_code == 429:
+            # просто лимит: cookies живые, браузер спросил бы так же — отдаём 429 с Retry-After
+            self.fallbacks["rate_limited"] = self.fallbacks.get("rate_limited", 0) + 1
+            raise UpstreamHTTPError("HTTP 429", retry_after=_retry_after_sec(r.headers), status=429)
+        if r.status_code in (401, 403):
+            self.invalidate("challenge")
+            raise _DirectUnavailable("challenge: HTTP %d" % r.status_code)
+        if r.status_code >= 500:
+            self.fallbacks["upstream_5xx"] = self.fallbacks.get("upstream_5xx", 0) + 1
+            raise _DirectUnavailable("HTTP %d" % r.status_code)
+        if r.status_code >= 400:
+            # окончательный ответ (например, товара нет) — браузер скажет то же самое
+            raise UpstreamHTTPError("HTTP %d: %s" % (r.status_code, r.text[:200]), status=r.status_code)
+        try:
+            data = r.json()
+        except ValueError:
+            # HTML вместо JSON — антибот-страница
+            self.invalidate("challenge")
+            raise _DirectUnavailable("non-JSON response")
+        self.calls += 1
+        return data
+
+    async def close(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "creds_age_sec": round(time.monotonic() - self._harvested_at, 1) if self._headers else None,
+            "harvests": self.harvests,
+            "calls": self.calls,
+            "fallbacks": dict(self.fallbacks),
+        }
+
+
+_direct = _DirectClient(DIRECT_BASE_URL) if DIRECT_HTTP and httpx is not None else None
+if DIRECT_HTTP and httpx is None:
+    logger.warning("CHIZHIK_DIRECT_HTTP=true, but httpx is not installed: using the browser only")
+
+
+def _batch_retryable(r) -> bool:
+    """Ошибка товара в пачке, которую стоит повторить вместе с сессией (не окончательный 4xx)."""
+    return isinstance(r, Exception) and _ERROR_POLICY[_classify_error(r)] != "fail"
+
+
+class _MicroBatcher:
+    """
+    Копит вызовы product_info за короткое окно и выполняет их пачкой в одном браузере:
+    одна сессия из пула, параллельные fetch на её странице, результаты раздаются ждущим.
+    """
+
+    def __init__(self, window_sec: float, max_size: int):
+        self.window_sec = window_sec
+        self.max_size = max_size
+        self._items: list = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.batches = 0
+        self.items = 0
+        self.max_batch = 0
+
+    async def submit(self, params: Dict[str, Any], priority: str):
+        fut = asyncio.get_running_loop().create_future()
+        self._items.append((params, fut, priority))
+        if len(self._items) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window_sec, self._flush)
+        return await fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self._items = self._items, []
+        if items:
+            asyncio.create_task(self._run(items))
+
+    async def _run(self, items: list):
+        # кто не дождался (клиент ушёл) — не запрашиваем
+        items = [it for it in items if not it[1].done()]
+        if not items:
+            return
+        self.batches += 1
+        self.items += len(items)
+        self.max_batch = max(self.max_batch, len(items))
+        priority = min((it[2] for it in items), key=lambda c: PRIORITY_CLASSES[c])
+
+        # у каждого товара свой результат или своя ошибка: чужой 404 не должен стать ответом на 503
+        results: list = [_UNSET] * len(items)
+
+        async def fn(api):
+            # на повторе (рестарт, челлендж, сеть) запрашиваем только то, что ещё не получено
+            todo = [i for i, r in enumerate(results) if r is _UNSET or _batch_retryable(r)]
+            got = await asyncio.gather(
+                *(_op_product_info(api, **items[i][0]) for i in todo),
+                return_exceptions=True,
+            )
+            for i, r in zip(todo, got):
+                results[i] = r
+            # ошибка сессии — пусть _call_session её лечит; временная ошибка у всех — апстрим болен
+            failed = [r for r in got if _batch_retryable(r)]
+            session = [r for r in failed if _ERROR_POLICY[_classify_error(r)] != "retry"]
+            if session:
+                raise session[0]
+            if failed and len(failed) == len(got):
+                raise failed[0]
+            return results
+
+        op = "product_info" if len(items) == 1 else "product_info_batch"
+        try:
+            await _call_chizhik(fn, op=op, priority=priority)
+        except Exception as e:
+            # до браузера не дошли (перегрузка, breaker) — этим товарам общая ошибка
+            results = [e if r is _UNSET else r for r in results]
+
+        for (_, fut, _), r in zip(items, results):
+            if fut.done():
+                continue
+            if isinstance(r, BaseException):
+                fut.set_exception(r)
+            else:
+                fut.set_result(r)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_ms": self.window_sec * 1000,
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "max_batch": self.max_batch,
+        }
+
+
+_batcher = _MicroBatcher(PRODUCT_BATCH_WINDOW_MS / 1000, PRODUCT_BATCH_MAX) if PRODUCT_BATCH_WINDOW_MS > 0 else None
 
-async def _call_chizhik(fn, *, retry_restart: bool = True):
+def _local_upstream_stats() -> Dict[str, Any]:
+    """Состояние апстрима в процессе, который держит браузеры."""
+    elapsed = _warmup_state["elapsed_sec"]
+    if elapsed is None and _warmup_state.get("started_at"):
+        elapsed = time.monotonic() - _warmup_state["started_at"]
+    return {
+        "warmup": _warmup_state["status"],
+        "warmup_error": _warmup_state["error"],
+        "warmup_progress": {
+            "phase": _warmup_state["phase"],
+            "done": _warmup_state["done"],
+            "total": _warmup_state["total"],
+            "failed": _warmup_state["failed"],
+            "elapsed_sec": round(elapsed, 1) if elapsed is not None else None,
+        },
+        "pool": _pool.stats(),
+        "breaker": _breaker.stats(),
+        "bulkheads": {name: b.stats() for name, b in _bulkheads.items()},
+        "latency": _latency.stats(),
+        "hedge": _hedger.stats(),
+        "direct": _direct.stats() if _direct is not None else None,
+        "browser_state": _browser_state.stats(),
+        "errors": _error_stats,
+        "batcher": _batcher.stats() if _batcher is not None else None,
+    }
+
+async def _call_direct(op: str, params: Dict[str, Any], priority: str):
     """
-    Все вызовы к chizhik_api через один lock:
-    - не плодим браузеры
-    - при падении/краше рестартим и пробуем 1 раз
+    Прямой HTTP под тем же admission control и bulkhead семейства, что и браузер.
+    Breaker прямые вызовы не кормят: их сбои уходят в браузер и учитываются там.
     """
-    async with _api_lock:
+    if not _direct.ready(op, params):
+        # без маршрута или cookies вызов откажет сразу — слот не занимаем
+        return await _direct.call(op, params)
+    _pool.admit(priority)
+    bulkhead = _bulkheads.get(_OP_FAMILY.get(op))
+    if bulkhead is None:
+        return await _direct.call(op, params)
+    # слот отпускаем до фолбэка: _call_chizhik займёт его заново
+    async with bulkhead.slot(priority, op):
+        return await _direct.call(op, params)
+
+async def _upstream(op: str, params: Optional[Dict[str, Any]] = None, *, priority: str = "interactive"):
+    """Вызов апстрима по имени операции: в этом процессе или через брокер."""
+    params = params or {}
+    if BROKER_SOCKET and not _is_broker:
+        return await _broker_client.call(op, params, priority=priority)
+    if _direct is not None and _breaker.state == "closed":
+        try:
+            return await _call_direct(op, params, priority)
+        except _DirectUnavailable as e:
+            logger.debug("Direct HTTP fallback for %s: %s", op, e)
+    if op == "product_info" and _batcher is not None:
+        return await _batcher.submit(params, priority)
+    fn = _UPSTREAM_OPS[op]
+    return await _call_chizhik(lambda api: fn(api, **params), op=op, priority=priority)
+
+async def _upstream_stats() -> Dict[str, Any]:
+    if BROKER_SOCKET and not _is_broker:
+        try:
+            return await _broker_client.call("__stats__", {})
+        except Exception as e:
+            return {"warmup": "error", "warmup_error": "broker unavailable: %s" % e}
+    return _local_upstream_stats()
+
+
+# -------- BROKER --------
+# Протокол: JSON по строке на сообщение через unix socket.
+#   -> {"id": 1, "op": "catalog_tree", "params": {...}}
+#   <- {"id": 1, "ok": true, "data": ...} | {"id": 1, "ok": false, "type": "...", "error": "..."}
+#   -> {"id": 1, "op": "__cancel__"}  (клиент ушёл — отменяем вызов)
+
+# какие ошибки брокера воссоздаём у воркера тем же типом
+_REMOTE_ERRORS = {
+    "UpstreamUnavailable": UpstreamUnavailable,
+    "UpstreamOverloaded": UpstreamOverloaded,
+    "DeadlineExceeded": DeadlineExceeded,
+    "UpstreamHTTPError": UpstreamHTTPError,
+}
+_BROKER_STREAM_LIMIT = 64 * 1024 * 1024  # деревья каталога — сотни КБ в одной строке
+_is_broker = False
+
+
+def _dumps_line(msg: Dict[str, Any]) -> bytes:
+    return json.dumps(msg, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+class _BrokerClient:
+    """Одно постоянное соединение воркера с брокером, запросы мультиплексируются по id."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._connect_lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return
+            self._reader, self._writer = await asyncio.open_unix_connection(self.path, limit=_BROKER_STREAM_LIMIT)
+            self._reader_task = asyncio.create_task(self._read_loop(self._reader))
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        err: Exception = ConnectionError("broker connection closed")
         try:
-            api = await _ensure_api()
-            return await asyncio.wait_for(fn(api), timeout=CHIZHIK_TIMEOUT_SEC)
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line)
+                fut = self._pending.pop(msg.get("id"), None)
+                if fut is None or fut.done():
+                    continue
+                if msg.get("ok"):
+                    fut.set_result(msg.get("data"))
+                else:
+                    cls = _REMOTE_ERRORS.get(msg.get("type"), UpstreamError)
+                    exc = cls(msg.get("error") or "broker error", retry_after=msg.get("retry_after"))
+                    if msg.get("status"):
+                        exc.status = msg["status"]
+                    fut.set_exception(exc)
         except Exception as e:
-            msg = str(e)
-            logger.error("Upstream error: %s", msg)
+            err = e
+        finally:
+            self._writer = None
+            pending, self._pending = self._pending, {}
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(err)
 
-            if retry_restart:
-                await _reset_api()
+    async def _send(self, msg: Dict[str, Any]):
+        await self._connect()
+        self._writer.write(_dumps_line(msg))
+        await self._writer.drain()
+
+    async def call(self, op: str, params: Dict[str, Any], priority: str = "interactive"):
+        rid = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[rid] = fut
+        try:
+            await self._send({"id": rid, "op": op, "params": params, "priority": priority})
+            return await asyncio.wait_for(asyncio.shield(fut), timeout=BROKER_TIMEOUT_SEC)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            if self._pending.pop(rid, None) is not None:
                 try:
-                    api = await _ensure_api()
-                    return await asyncio.wait_for(fn(api), timeout=CHIZHIK_TIMEOUT_SEC)
-                except Exception as e2:
-                    logger.error("Upstream error after restart: %s", str(e2))
-                    raise
+                    await self._send({"id": rid, "op": "__cancel__"})
+                except Exception:
+                    pass
             raise
+        finally:
+            self._pending.pop(rid, None)
+
+    async def close(self):
+        w, self._writer = self._writer, None
+        if w is not None:
+            w.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+
+
+_broker_client = _BrokerClient(BROKER_SOCKET) if BROKER_SOCKET else None
+
+
+async def _broker_handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    tasks: Dict[int, asyncio.Task] = {}
+    write_lock = asyncio.Lock()
+
+    async def reply(msg: Dict[str, Any]):
+        async with write_lock:
+            writer.write(_dumps_line(msg))
+            await writer.drain()
+
+    async def run(rid: int, op: str, params: Dict[str, Any], priority: str):
+        try:
+            if op == "__stats__":
+                data = _local_upstream_stats()
+            else:
+                data = await _upstream(op, params, priority=priority)
+            await reply({"id": rid, "ok": True, "data": data})
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            try:
+                await reply({
+                    "id": rid,
+                    "ok": False,
+                    "type": type(e).__name__,
+                    "error": str(e),
+                    "retry_after": getattr(e, "retry_after", None),
+                    "status": getattr(e, "status", None),
+                })
+            except Exception:
+                pass
+        finally:
+            tasks.pop(rid, None)
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            msg = json.loads(line)
+            rid, op = msg.get("id"), msg.get("op")
+            if op == "__cancel__":
+                t = tasks.pop(rid, None)
+                if t is not None:
+                    t.cancel()
+                continue
+            if op != "__stats__" and op not in _UPSTREAM_OPS:
+                await reply({"id": rid, "ok": False, "type": "KeyError", "error": "unknown op: %s" % op})
+                continue
+            priority = msg.get("priority") if msg.get("priority") in PRIORITY_CLASSES else "interactive"
+            tasks[rid] = asyncio.create_task(run(rid, op, msg.get("params") or {}, priority))
+    except Exception as e:
+        logger.error("Broker connection error: %s", e)
+    finally:
+        # воркер отвалился — его вызовы больше никому не нужны
+        for t in list(tasks.values()):
+            t.cancel()
+        writer.close()
+
+
+async def serve_broker(path: str):
+    """Долгоживущий процесс с браузерами; HTTP-воркеры ходят к нему через unix socket."""
+    global _is_broker
+    _is_broker = True
+    # брокер сам кладёт прогретые данные в кэш
+    await _connect_redis()
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(_broker_handle, path=path, limit=_BROKER_STREAM_LIMIT)
+    logger.info("Broker listening on %s (pool size %d)", path, CHIZHIK_POOL_SIZE)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    warmup = asyncio.create_task(_warmup_task())
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        warmup.cancel()
+        await _pool.close()
+        await _close_redis()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+class _SingleFlight:
+    """
+    Схлопывает одинаковые параллельные запросы (по ключу кэша):
+    апстрим вызывается один раз, остальные ждут тот же результат.
+    Работает в памяти процесса, с Redis и без.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.max_waiters = 0
+        self.abandoned = 0
+
+    async def do(self, key: str, fn, deadline: Optional[float] = None):
+        """
+        deadline (time.monotonic()): дольше этого не ждём — DeadlineExceeded.
+        Когда не осталось ни одного ждущего (ушли по дедлайну или клиент отключился),
+        вызов отменяется: убирается из очереди к браузеру или обрывается.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            # отдельная задача: отмена первого клиента не ломает остальных
+            task = asyncio.create_task(fn())
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._calls[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda _t: self._forget(key, _t))
+        else:
+            self.coalesced += 1
+        self._waiters[key] += 1
+        self.max_waiters = max(self.max_waiters, self._waiters[key])
+        try:
+            if deadline is None:
+                return await asyncio.shield(task)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded("request deadline exceeded before upstream call")
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), remaining)
+            except asyncio.TimeoutError:
+                if task.done():
+                    raise
+                _request_stats["deadline_exceeded"] += 1
+                raise DeadlineExceeded("request deadline exceeded waiting for upstream")
+        finally:
+            if not task.done() and self._calls.get(key) is task:
+                self._waiters[key] -= 1
+                if self._waiters[key] <= 0:
+                    # результат больше никому не нужен
+                    self.abandoned += 1
+                    task.cancel()
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+            self._waiters.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._calls),
+            "waiting": sum(self._waiters.values()),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "max_waiters": self.max_waiters,
+            "abandoned": self.abandoned,
+        }
+
+
+_singleflight = _SingleFlight()
+_BUILDING = object()
+
+def _upstream_error_response(e: Exception) -> JSONResponse:
+    """Апстрим не ответил: 503 (429 при перегрузке, 504 по дедлайну). Устаревшее отдаёт _cached_lookup."""
+    if isinstance(e, UpstreamHTTPError) and 400 <= e.status < 500 and e.status not in (401, 403, 429):
+        # ответ апстрима окончательный (например, 404) — отдаём его код, устаревшая копия не нужна
+        return JSONResponse({"detail": "Upstream error", "error": str(e)}, status_code=e.status)
+    headers = {}
+    retry_after = getattr(e, "retry_after", None)
+    if retry_after:
+        headers["Retry-After"] = str(int(retry_after + 0.999))
+    if isinstance(e, UpstreamOverloaded) or isinstance(e, UpstreamHTTPError) and e.status == 429:
+        return JSONResponse({"detail": "Too many requests", "error": str(e)}, status_code=429, headers=headers)
+    if isinstance(e, DeadlineExceeded):
+        return JSONResponse({"detail": "Deadline exceeded", "error": str(e)}, status_code=504)
+    return JSONResponse({"detail": "Upstream error", "error": str(e)}, status_code=503, headers=headers)
+
+def _hard_ttl(ttl: int) -> int:
+    """Сколько ключ живёт в кэше: мягкий TTL + окно, в котором его можно отдавать устаревшим."""
+    return max(ttl, int(ttl * CACHE_HARD_TTL_FACTOR), STALE_TTL_SEC)
+
+
+_swr_refreshing: Dict[str, asyncio.Task] = {}
+_build_wait_stats = {"woken": 0, "timeouts": 0}
+_swr_stats = {"fresh": 0, "stale": 0, "miss": 0, "refreshes": 0, "refresh_failures": 0, "refresh_skipped": 0}
+
+def _revalidate(key: str, fetch, fresh_left: float):
+    """
+    Одно фоновое обновление устаревшего ключа (в процессе — по задаче, между инстансами — по lock).
+    fresh_left: при каком остатке TTL ключ ещё свежий (hard_ttl - ttl).
+    """
+    if key in _swr_refreshing:
+        return
+
+    async def run():
+        # задача унаследовала контекст запроса — без его дедлайна (он же читается в fetch и _upstream)
+        _deadline_var.set(None)
+        if not await cache_lock(_cache_key("lock", "refresh", key), ttl=SWR_REFRESH_LOCK_SEC):
+            return
+        try:
+            # устаревшее мы видели, возможно, в L1, а другой инстанс уже обновил ключ и отпустил lock
+            hit = await cache_get_entry(key, skip_l1=True)
+            if hit is not None and (hit[1] is None or hit[1] > fresh_left):
+                _swr_stats["refresh_skipped"] += 1
+                return
+            _swr_stats["refreshes"] += 1
+            await _singleflight.do(key, fetch, deadline=None)
+        except Exception as e:
+            _swr_stats["refresh_failures"] += 1
+            logger.warning("Background refresh of %s failed: %s", key, str(e))
+        finally:
+            await cache_unlock(_cache_key("lock", "refresh", key))
+
+    task = asyncio.create_task(run())
+    _swr_refreshing[key] = task
+    task.add_done_callback(lambda _t: _swr_refreshing.pop(key, None))
+
+async def _cached_lookup(
+    key: str,
+    ttl: int,
+    op: str,
+    params: Optional[Dict[str, Any]] = None,
+    *,
+    lock_key: Optional[str] = None,
+    lock_ttl: int = 90,
+    priority: str = "interactive",
+):
+    """
+    Кэш -> singleflight -> chizhik -> кэш. Возвращает (_CacheEntry или _BUILDING, "fresh"/"stale"/"miss"),
+    ошибки апстрима бросает.
+    ttl — мягкий TTL: после него и до _hard_ttl(ttl) ответ отдаётся устаревшим, а обновление
+    уходит в фон с приоритетом prefetch.
+    lock_key: дополнительно держим lock в Redis (между инстансами).
+    """
+    hard_ttl = _hard_ttl(ttl)
+
+    def fetcher(prio: str):
+        async def fetch():
+            if lock_key:
+                wait_until = time.monotonic() + BUILD_WAIT_SEC
+                deadline = _deadline_var.get()
+                if deadline is not None:
+                    # 202 успеваем отдать раньше, чем запрос упрётся в дедлайн (504)
+                    wait_until = min(wait_until, deadline - 0.25)
+                while not await cache_lock(lock_key, ttl=lock_ttl):
+                    # уже строится другим инстансом — ждём его результат
+                    left = wait_until - time.monotonic()
+                    if left <= 0:
+                        _build_wait_stats["timeouts"] += 1
+                        return _BUILDING
+                    entry = await cache_wait(key, left)
+                    if entry is not None:
+                        _build_wait_stats["woken"] += 1
+                        return entry
+                    # держатель закончил без результата (или не дождались) — пробуем lock сами
+            try:
+                data = await _upstream(op, params, priority=prio)
+                # кодируем и сжимаем один раз: эти же байты уйдут и в кэш, и в ответ
+                entry = await asyncio.to_thread(_CacheEntry.from_data, data)
+                await cache_set_entry(key, entry, hard_ttl)
+                return entry
+            finally:
+                if lock_key:
+                    await cache_unlock(lock_key)
+                    await cache_notify(key)
+        return fetch
+
+    hit = await cache_get_entry(key)
+    if hit is not None:
+        entry, left = hit
+        if left is None or left > hard_ttl - ttl:
+            _swr_stats["fresh"] += 1
+            return entry, "fresh"
+        _swr_stats["stale"] += 1
+        _revalidate(key, fetcher("prefetch"), hard_ttl - ttl)
+        return entry, "stale"
+
+    _swr_stats["miss"] += 1
+    entry = await _singleflight.do(key, fetcher(priority), deadline=_deadline_var.get())
+    return entry, "miss"
+
+async def _cached_get(key: str, ttl: int, op: str, params: Optional[Dict[str, Any]] = None, **kw):
+    """Как _cached_lookup, но разобранные данные (или _BUILDING)."""
+    entry, _state = await _cached_lookup(key, ttl, op, params, **kw)
+    return entry if entry is _BUILDING else entry.data
+
+def _entry_response(entry: _CacheEntry, state: str) -> Response:
+    """Готовые байты из кэша как есть: сжатый вариант по Accept-Encoding, без json.dumps и GZipMiddleware."""
+    body, encoding = entry.body_for(_accept_encoding_var.get())
+    headers = {"X-Cache": state, "Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+async def _cached_fetch(key: str, ttl: int, op: str, params: Optional[Dict[str, Any]] = None, **kw):
+    """Общий путь публичных ручек: данные (X-Cache: fresh/stale/miss), 202 пока строит другой инстанс, 503/429 при ошибке."""
+    try:
+        entry, state = await _cached_lookup(key, ttl, op, params, **kw)
+    except Exception as e:
+        return _upstream_error_response(e)
+    if entry is _BUILDING:
+        return JSONResponse({"status": "building"}, status_code=202)
+    return _entry_response(entry, state)
+
+def _warmup_items() -> list:
+    """Горячие данные для прогрева в порядке приоритета: акции, деревья городов, первые страницы категорий."""
+    items = []
+    for city_id in WARMUP_CITIES:
+        items.append(("tree:%s" % city_id, lambda c=city_id: _cached_get(
+            _cache_key("catalog", "tree", c),
+            TTL_TREE_SEC,
+            "catalog_tree",
+            {"city_id": c},
+            lock_key=_cache_key("lock", "tree", c),
+            lock_ttl=120,
+            priority="warmup",
+        )))
+    for page in range(1, WARMUP_PRODUCT_PAGES + 1):
+        for city_id in WARMUP_CITIES:
+            for category_id in WARMUP_CATEGORIES:
+                items.append((
+                    "products:%s:%s:%d" % (city_id, category_id, page),
+                    lambda c=city_id, cat=category_id, p=page: _products_page(c, cat, None, p, "warmup"),
+                ))
+    return items
 
 async def _warmup_task():
+    """
+    Прогрев в фоне (не блокирует /health):
+    1) все браузеры пула запускаются параллельно;
+    2) акции — по ним решаем, что апстрим жив (status ready);
+    3) деревья WARMUP_CITIES и первые страницы WARMUP_CATEGORIES, приоритет warmup.
+    """
     global _warmup_state
+    _standby.refill()
+    asyncio.create_task(_pool.monitor())
+
+    # без кэша (ни Redis, ни L1) заранее загруженные данные некуда положить
+    items = _warmup_items() if _cache_enabled() else []
+    t0 = time.monotonic()
+    _warmup_state.update(
+        status="starting", error=None, phase="sessions",
+        done=0, total=len(_pool.sessions) + 1 + len(items), failed=0,
+        started_at=t0, elapsed_sec=None,
+    )
+
+    errors = await _pool.start_all()
+    _warmup_state["done"] += len(_pool.sessions) - len(errors)
+    _warmup_state["failed"] += len(errors)
+    for e in errors:
+        logger.error("Warmup: session launch failed: %s", e)
+
+    _warmup_state["phase"] = "offers"
     try:
-        await _call_chizhik(lambda api: api.Advertising.active_inout(), retry_restart=True)
+        # мимо кэша: прогретый Redis ответит и тогда, когда ни один браузер не поднялся
+        data = await _call_chizhik(_op_offers_active, op="offers_active", priority="warmup", retry_restart=True)
+        if _cache_enabled():
+            entry = await asyncio.to_thread(_CacheEntry.from_data, data)
+            await cache_set_entry("offers:active", entry, _hard_ttl(TTL_OFFERS_SEC))
+        _warmup_state["done"] += 1
         _warmup_state["status"] = "ready"
         _warmup_state["error"] = None
     except Exception as e:
+        _warmup_state["failed"] += 1
         _warmup_state["status"] = "error"
         _warmup_state["error"] = str(e)
+        _warmup_state["phase"] = None
+        _warmup_state["elapsed_sec"] = time.monotonic() - t0
+        return
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    global rds
-    if REDIS_URL and redis is not None:
-        rds = redis.from_url(REDIS_URL, encoding="utf-8", decode_responses=True)
+    _warmup_state["phase"] = "data"
+    sem = asyncio.Semaphore(WARMUP_CONCURRENCY)
 
-    # прогрев в фоне (не блокирует старт/health)
-    asyncio.create_task(_warmup_task())
+    async def preload(name: str, load):
+        async with sem:
+            try:
+                await load()
+                _warmup_state["done"] += 1
+            except Exception as e:
+                _warmup_state["failed"] += 1
+                logger.warning("Warmup: %s failed: %s", name, e)
 
-    yield
+    # задачи стартуют по порядку списка, а в очередь к браузерам встают с приоритетом warmup
+    await asyncio.gather(*(preload(name, load) for name, load in items))
+    _warmup_state["phase"] = None
+    _warmup_state["elapsed_sec"] = time.monotonic() - t0
+    logger.info(
+        "Warmup finished in %.1fs: %d done, %d failed",
+        _warmup_state["elapsed_sec"], _warmup_state["done"], _warmup_state["failed"],
+    )
 
-    await _reset_api()
+async def _connect_redis():
+    global rds
+    if REDIS_URL and redis is not None:
+        # без decode_responses: в кэше лежат байты (JSON и его сжатые варианты)
+        rds = redis.from_url(REDIS_URL)
+
+async def _close_redis():
     try:
         if rds:
             await rds.aclose()
     except Exception:
         pass
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await _connect_redis()
+
+    # прогрев в фоне (не блокирует старт/health); с брокером браузеры греет он
+    if not BROKER_SOCKET:
+        asyncio.create_task(_warmup_task())
+
+    yield
+
+    if _broker_client is not None:
+        await _broker_client.close()
+    else:
+        await _pool.close()
+    await _close_redis()
+
+def _request_budget(scope) -> float:
+    for k, v in scope.get("headers") or []:
+        if k == b"x-request-budget-ms":
+            try:
+                budget = float(v) / 1000
+            except ValueError:
+                break
+            # NaN, inf, 0 и отрицательные — кривой заголовок, а не просьба ответить 504 сразу
+            if math.isfinite(budget) and budget > 0:
+                return min(REQUEST_BUDGET_MAX_SEC, budget)
+            break
+    path = scope.get("path", "")
+    for prefix, budget in REQUEST_BUDGETS:
+        if path.startswith(prefix):
+            return budget
+    return REQUEST_BUDGET_SEC
+
+
+class _DeadlineMiddleware:
+    """
+    Дедлайн запроса в _deadline_var и отмена обработки, если клиент отключился
+    до ответа: ожидание апстрима снимается (см. _SingleFlight.do).
+    Заодно Accept-Encoding в _accept_encoding_var — для готовых сжатых тел из кэша.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        token = _deadline_var.set(time.monotonic() + _request_budget(scope))
+        accept = next((v.decode("latin-1") for k, v in scope.get("headers", ()) if k == b"accept-encoding"), "")
+        enc_token = _accept_encoding_var.set(accept)
+        inbox: asyncio.Queue = asyncio.Queue()
+        state = {"responded": False, "disconnected": False}
+
+        async def send_wrapper(msg):
+            if msg["type"] == "http.response.body" and not msg.get("more_body", False):
+                state["responded"] = True
+            await send(msg)
+
+        try:
+            app_task = asyncio.create_task(self.app(scope, inbox.get, send_wrapper))
+        finally:
+            _deadline_var.reset(token)
+            _accept_encoding_var.reset(enc_token)
+
+        async def pump():
+            while True:
+                msg = await receive()
+                await inbox.put(msg)
+                if msg["type"] == "http.disconnect":
+                    if not state["responded"] and not app_task.done():
+                        state["disconnected"] = True
+                        _request_stats["client_disconnects"] += 1
+                        app_task.cancel()
+                    return
+
+        pump_task = asyncio.create_task(pump())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not state["disconnected"]:
+                app_task.cancel()
+                raise
+        finally:
+            pump_task.cancel()
+
+
 app = FastAPI(title="Chizhik Catalog Backend", version="3.0.0", lifespan=lifespan)
 
 app.add_middleware(GZipMiddleware, minimum_size=1000)
@@ -175,7 +2943,6 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-
 @app.middleware("http")
 async def api_key_guard(request: Request, call_next):
     if request.method == "OPTIONS":
@@ -191,6 +2958,10 @@ async def api_key_guard(request: Request, call_next):
 
     return await call_next(request)
 
+# последним — значит самым внешним: при отключении клиента отменяем всё, включая
+# api_key_guard (BaseHTTPMiddleware без ответа изнутри падает с "No response returned")
+app.add_middleware(_DeadlineMiddleware)
+
 @app.get("/", include_in_schema=False)
 async def root():
     return {"ok": True, "service": "chizhik-backend"}
@@ -198,11 +2969,18 @@ async def root():
 @app.get("/health", include_in_schema=False)
 @app.get("/health/", include_in_schema=False)
 async def health():
+    upstream = await _upstream_stats()
     return {
         "ok": True,
         "cache": "redis" if rds else "none",
-        "warmup": _warmup_state["status"],
-        "warmup_error": _warmup_state["error"],
+        "l1": _l1.stats() if _l1 is not None else None,
+        "codec": {"responses": _codec.name, "internal": _internal_codec.name},
+        "broker": BROKER_SOCKET,
+        **upstream,
+        "singleflight": _singleflight.stats(),
+        "swr": {**_swr_stats, "refreshing": len(_swr_refreshing)},
+        "build_wait": dict(_build_wait_stats),
+        "requests": dict(_request_stats),
     }
 
 @app.get("/favicon.ico", include_in_schema=False)
@@ -214,66 +2992,29 @@ async def favicon():
 
 @app.get("/public/geo/cities")
 async def geo_cities(search: str = Query(...), page: int = 1):
-    key = _cache_key("geo", "cities", search, page)
-    cached = await cache_get_json(key)
-    if cached is not None:
-        return cached
-
-    async def run(api):
-        r = await api.Geolocation.cities_list(search_name=search, page=page)
-        return r.json()
-
-    try:
-        data = await _call_chizhik(run)
-        await cache_set_json(key, data, TTL_GEO_SEC)
-        return data
-    except Exception as e:
-        return JSONResponse({"detail": "Upstream error", "error": str(e)}, status_code=503)
+    return await _cached_fetch(
+        _cache_key("geo", "cities", search, page),
+        TTL_GEO_SEC,
+        "geo_cities",
+        {"search": search, "page": page},
+    )
 
 
 @app.get("/public/offers/active")
 async def offers_active():
-    key = "offers:active"
-    cached = await cache_get_json(key)
-    if cached is not None:
-        return cached
-
-    async def run(api):
-        r = await api.Advertising.active_inout()
-        return r.json()
-
-    try:
-        data = await _call_chizhik(run)
-        await cache_set_json(key, data, TTL_OFFERS_SEC)
-        return data
-    except Exception as e:
-        return JSONResponse({"detail": "Upstream error", "error": str(e)}, status_code=503)
+    return await _cached_fetch("offers:active", TTL_OFFERS_SEC, "offers_active")
 
 
 @app.get("/public/catalog/tree")
 async def catalog_tree(city_id: str):
-    key = _cache_key("catalog", "tree", city_id)
-    cached = await cache_get_json(key)
-    if cached is not None:
-        return cached
-
-    lock_key = _cache_key("lock", "tree", city_id)
-    if not await cache_lock(lock_key, ttl=120):
-        # уже строится другим запросом
-        return JSONResponse({"status": "building"}, status_code=202)
-
-    try:
-        async def run(api):
-            r = await api.Catalog.tree(city_id=city_id)
-            return r.json()
-
-        data = await _call_chizhik(run)
-        await cache_set_json(key, data, TTL_TREE_SEC)
-        return data
-    except Exception as e:
-        return JSONResponse({"detail": "Upstream error", "error": str(e)}, status_code=503)
-    finally:
-        await cache_unlock(lock_key)
+    return await _cached_fetch(
+        _cache_key("catalog", "tree", city_id),
+        TTL_TREE_SEC,
+        "catalog_tree",
+        {"city_id": city_id},
+        lock_key=_cache_key("lock", "tree", city_id),
+        lock_ttl=120,
+    )
 
 
 @app.get("/public/catalog/products")
@@ -283,52 +3024,103 @@ async def catalog_products(
     category_id: Optional[int] = None,
     search: Optional[str] = None,
 ):
-    key = _cache_key("catalog", "products", city_id, category_id, search, page)
-    cached = await cache_get_json(key)
-    if cached is not None:
-        return cached
-
     # защита от "кликов" по одной и той же категории
-    lock_key = _cache_key("lock", "products", city_id, category_id, search, page)
-    if not await cache_lock(lock_key, ttl=60):
-        return JSONResponse({"status": "building"}, status_code=202)
+    return await _cached_fetch(
+        _cache_key("catalog", "products", city_id, category_id, search, page),
+        TTL_PRODUCTS_SEC,
+        "catalog_products",
+        {"city_id": city_id, "page": page, "category_id": category_id, "search": search},
+        lock_key=_cache_key("lock", "products", city_id, category_id, search, page),
+        lock_ttl=60,
+    )
 
-    try:
-        async def run(api):
-            r = await api.Catalog.products_list(
-                page=page,
-                category_id=category_id,
-                city_id=city_id,
-                search=search,
-            )
-            return r.json()
 
-        data = await _call_chizhik(run)
-        await cache_set_json(key, data, TTL_PRODUCTS_SEC)
+def _page_items(data: Any) -> list:
+    """Список товаров из ответа products_list."""
+    if isinstance(data, list):
         return data
-    except Exception as e:
-        return JSONResponse({"detail": "Upstream error", "error": str(e)}, status_code=503)
-    finally:
-        await cache_unlock(lock_key)
+    if isinstance(data, dict):
+        for k in ("items", "results", "products", "data"):
+            if isinstance(data.get(k), list):
+                return data[k]
+    return []
 
+def _page_count(data: Any) -> int:
+    """Сколько всего страниц у выдачи (по полям пагинации, иначе по count / размеру страницы)."""
+    if not isinstance(data, dict):
+        return 1
+    for k in ("total_pages", "pages", "page_count", "num_pages"):
+        if isinstance(data.get(k), int):
+            return max(1, data[k])
+    count, size = data.get("count"), len(_page_items(data))
+    if isinstance(count, int) and size:
+        return max(1, -(-count // size))
+    return 1
 
-@app.get("/public/product/info")
-async def product_info(product_id: int, city_id: Optional[str] = None):
-    key = _cache_key("product", "info", product_id, city_id)
-    cached = await cache_get_json(key)
-    if cached is not None:
-        return cached
+async def _products_page(city_id: str, category_id: Optional[int], search: Optional[str], page: int, priority: str):
+    return await _cached_get(
+        _cache_key("catalog", "products", city_id, category_id, search, page),
+        TTL_PRODUCTS_SEC,
+        "catalog_products",
+        {"city_id": city_id, "page": page, "category_id": category_id, "search": search},
+        lock_key=_cache_key("lock", "products", city_id, category_id, search, page),
+        lock_ttl=60,
+        priority=priority,
+    )
 
-    async def run(api):
-        r = await api.Catalog.Product.info(product_id=product_id, city_id=city_id)
-        return r.json()
 
+@app.get("/public/catalog/products/all")
+async def catalog_products_all(
+    city_id: str,
+    category_id: Optional[int] = None,
+    search: Optional[str] = None,
+    max_pages: int = Query(FANOUT_MAX_PAGES, ge=1),
+):
+    """
+    Все страницы выдачи одним ответом: первая страница даёт число страниц,
+    остальные тянутся параллельно (не больше FANOUT_CONCURRENCY), каждая кэшируется
+    под тем же ключом, что и /public/catalog/products.
+    """
     try:
-        data = await _call_chizhik(run)
-        await cache_set_json(key, data, TTL_PRODUCT_INFO_SEC)
-        return data
+        first = await _products_page(city_id, category_id, search, 1, "interactive")
     except Exception as e:
-        return JSONResponse({"detail": "Upstream error", "error": str(e)}, status_code=503)
+        return _upstream_error_response(e)
+    if first is _BUILDING:
+        return JSONResponse({"status": "building"}, status_code=202)
+
+    pages = min(_page_count(first), max_pages, FANOUT_MAX_PAGES)
+    sem = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def one(page: int):
+        async with sem:
+            return await _products_page(city_id, category_id, search, page, "prefetch")
+
+    rest = await asyncio.gather(*(one(p) for p in range(2, pages + 1)), return_exceptions=True)
+
+    items = list(_page_items(first))
+    failed = []
+    for page, data in enumerate(rest, start=2):
+        if isinstance(data, BaseException) or data is _BUILDING:
+            failed.append(page)
+            continue
+        items.extend(_page_items(data))
+
+    return {
+        "count": first.get("count", len(items)) if isinstance(first, dict) else len(items),
+        "pages": pages,
+        "failed_pages": failed,
+        "items": items,
+    }
+
+
+@app.get("/public/product/info")
+async def product_info(product_id: int, city_id: Optional[str] = None):
+    return await _cached_fetch(
+        _cache_key("product", "info", product_id, city_id),
+        TTL_PRODUCT_INFO_SEC,
+        "product_info",
+        {"product_id": product_id, "city_id": city_id},
+    )
 
 
 # -------- PRIVATE API --------
@@ -336,3 +3128,58 @@ async def product_info(product_id: int, city_id: Optional[str] = None):
 @app.get("/private/ping")
 async def private_ping():
     return {"ok": True, "private": True}
+
+
+# -------- LOCAL RUN --------
+# python app.py broker                      — только брокер с браузерами
+# python app.py local --workers 4           — брокер + uvicorn с N воркерами на одной машине
+# (нагрузка: python bench.py http --url http://127.0.0.1:8080/public/offers/active)
+
+def _run_local(args):
+    import subprocess
+    import uvicorn
+
+    broker = None
+    if args.workers > 1 or args.broker:
+        sock = BROKER_SOCKET or "/tmp/chizhik-broker.sock"
+        env = dict(os.environ, CHIZHIK_BROKER_SOCKET=sock)
+        if os.path.exists(sock):
+            os.unlink(sock)
+        broker = subprocess.Popen([sys.executable, os.path.abspath(__file__), "broker"], env=env)
+        deadline = time.monotonic() + 30
+        while not os.path.exists(sock):
+            if broker.poll() is not None or time.monotonic() > deadline:
+                raise SystemExit("broker did not start")
+            time.sleep(0.1)
+        # воркеры uvicorn наследуют окружение
+        os.environ["CHIZHIK_BROKER_SOCKET"] = sock
+
+    try:
+        uvicorn.run("app:app", host=args.host, port=args.port, workers=args.workers)
+    finally:
+        if broker is not None:
+            broker.terminate()
+            try:
+                broker.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                broker.kill()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Chizhik backend")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_broker = sub.add_parser("broker", help="процесс-брокер с браузерами ChizhikAPI")
+    p_broker.add_argument("--socket", default=BROKER_SOCKET or "/tmp/chizhik-broker.sock")
+    p_local = sub.add_parser("local", help="брокер + uvicorn с несколькими воркерами")
+    p_local.add_argument("--host", default="127.0.0.1")
+    p_local.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    p_local.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "1")))
+    p_local.add_argument("--broker", action="store_true", help="брокер даже при одном воркере")
+    args = parser.parse_args()
+
+    if args.cmd == "broker":
+        asyncio.run(serve_broker(args.socket))
+    else:
+        _run_local(args)
@@ -0,0 +1,179 @@
+"""
+Простые бенчмарки бэкенда.
+
+  python bench.py http --url http://127.0.0.1:8080/public/offers/active -c 50 -n 2000
+  python bench.py codecs                     # кодеки кэша на синтетических ответах
+  python bench.py codecs --payloads ./payloads
+
+Записанные ответы для codecs — *.json в каталоге, имя файла = подпись в отчёте:
+  curl -s "http://127.0.0.1:8080/public/catalog/tree?city_id=..." -H "Accept-Encoding: identity" > payloads/tree.json
+
+Сравнение воркеров на одной машине:
+  python app.py local --workers 1            # и в другом терминале bench
+  python app.py local --workers 4
+"""
+import os
+import sys
+import gzip
+import json
+import glob
+import time
+import random
+import argparse
+import http.client
+import threading
+from urllib.parse import urlsplit
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def bench_http(args):
+    u = urlsplit(args.url)
+    path = u.path + ("?" + u.query if u.query else "")
+    headers = {"Accept-Encoding": "gzip"} if args.gzip else {}
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+
+    def worker():
+        conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=args.timeout)
+        local_lat, local_st = [], {}
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            t0 = time.perf_counter()
+            try:
+                conn.request("GET", path, headers=headers)
+                r = conn.getresponse()
+                r.read()
+                code = r.status
+            except Exception:
+                conn.close()
+                conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=args.timeout)
+                code = "error"
+            local_lat.append(time.perf_counter() - t0)
+            local_st[code] = local_st.get(code, 0) + 1
+        conn.close()
+        with lock:
+            latencies.extend(local_lat)
+            for k, v in local_st.items():
+                statuses[k] = statuses.get(k, 0) + v
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    print("requests: %d  concurrency: %d  elapsed: %.2fs" % (len(latencies), args.concurrency, elapsed))
+    print("rps: %.1f" % (len(latencies) / elapsed if elapsed else 0))
+    print("latency ms: p50=%.1f p95=%.1f p99=%.1f max=%.1f" % (
+        _percentile(latencies, 0.50) * 1000,
+        _percentile(latencies, 0.95) * 1000,
+        _percentile(latencies, 0.99) * 1000,
+        max(latencies, default=0) * 1000,
+    ))
+    print("statuses:", statuses)
+
+
+def _synthetic_payloads():
+    """Ответы похожей формы: дерево каталога, страница товаров, карточка товара."""
+    rnd = random.Random(42)
+    words = ["Молоко", "Сыр", "Хлеб", "Чай", "Кофе", "Сок", "Вода", "Масло", "Крупа", "Печенье", "Овощи", "Фрукты"]
+
+    def name(n=3):
+        return " ".join(rnd.choice(words) for _ in range(n))
+
+    def category(depth, cid):
+        node = {"id": cid, "name": name(), "slug": "cat-%d" % cid, "image": "https://img.example/%d.png" % cid,
+                "is_adult": False, "products_count": rnd.randint(0, 500)}
+        node["children"] = [category(depth - 1, cid * 10 + i) for i in range(8)] if depth else []
+        return node
+
+    def product(pid):
+        return {"id": pid, "title": name(5), "price": round(rnd.uniform(30, 3000), 2),
+                "old_price": None if rnd.random() < 0.7 else round(rnd.uniform(30, 3000), 2),
+                "images": ["https://img.example/p/%d/%d.jpg" % (pid, i) for i in range(3)],
+                "rating": round(rnd.uniform(3, 5), 1), "in_stock": rnd.random() < 0.9, "unit": "шт"}
+
+    info = product(1)
+    info.update(description=" ".join(name(8) for _ in range(30)),
+                specs=[{"name": name(2), "value": name(1)} for _ in range(25)],
+                breadcrumbs=[{"id": i, "name": name(2)} for i in range(4)])
+    return {
+        "tree": [category(2, i) for i in range(1, 13)],
+        "products": {"count": 950, "total_pages": 32, "items": [product(i) for i in range(30)]},
+        "product_info": info,
+    }
+
+def _timeit(fn, number, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - t0) / number)
+    return best
+
+def bench_codecs(args):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import _CODECS  # те же кодеки, что выбирает CACHE_CODEC
+
+    if args.payloads:
+        payloads = {}
+        for path in sorted(glob.glob(os.path.join(args.payloads, "*.json"))):
+            with open(path, encoding="utf-8") as f:
+                payloads[os.path.splitext(os.path.basename(path))[0]] = json.load(f)
+        if not payloads:
+            print("no *.json in", args.payloads)
+            return 1
+    else:
+        payloads = _synthetic_payloads()
+
+    missing = [n for n in ("orjson", "msgspec", "msgpack") if n not in _CODECS]
+    if missing:
+        print("not installed (skipped):", ", ".join(missing))
+    print("%-14s %-8s %10s %10s %10s %10s" % ("payload", "codec", "bytes", "gzip", "enc us", "dec us"))
+    for label, data in payloads.items():
+        for name, factory in _CODECS.items():
+            codec = factory()
+            raw = codec.dumps(data)
+            enc = _timeit(lambda: codec.dumps(data), args.number, args.repeat)
+            dec = _timeit(lambda: codec.loads(raw), args.number, args.repeat)
+            print("%-14s %-8s %10d %10d %10.1f %10.1f" % (
+                label, name, len(raw), len(gzip.compress(raw, 6)), enc * 1e6, dec * 1e6,
+            ))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chizhik backend benchmarks")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_http = sub.add_parser("http", help="нагрузка на HTTP-ручку")
+    p_http.add_argument("--url", required=True)
+    p_http.add_argument("-c", "--concurrency", type=int, default=50)
+    p_http.add_argument("-n", "--requests", type=int, default=2000)
+    p_http.add_argument("--timeout", type=float, default=120)
+    p_http.add_argument("--gzip", action="store_true", help="слать Accept-Encoding: gzip")
+    p_http.set_defaults(func=bench_http)
+
+    p_codecs = sub.add_parser("codecs", help="кодеки кэша: время encode/decode и размер")
+    p_codecs.add_argument("--payloads", help="каталог с записанными ответами *.json (иначе синтетика)")
+    p_codecs.add_argument("--number", type=int, default=50, help="вызовов в замере")
+    p_codecs.add_argument("--repeat", type=int, default=5, help="замеров, берётся лучший")
+    p_codecs.set_defaults(func=bench_codecs)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
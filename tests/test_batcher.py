@@ -0,0 +1,56 @@
+import asyncio
+
+import app
+
+
+def _batch(monkeypatch, answers):
+    """Пачка product_info по answers[product_id] -> список ответов по попыткам; (результаты, запрошенные id)."""
+    requested = []
+
+    async def product_info(api, product_id, city_id=None):
+        requested.append(product_id)
+        r = answers[product_id].pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+    async def call_chizhik(fn, *, op=None, priority="interactive", retry_restart=True):
+        # как _call_session: ошибку сессии лечим и повторяем один раз
+        try:
+            return await fn(None)
+        except Exception:
+            return await fn(None)
+
+    monkeypatch.setattr(app, "_op_product_info", product_info)
+    monkeypatch.setattr(app, "_call_chizhik", call_chizhik)
+    batcher = app._MicroBatcher(0.01, 10)
+
+    async def main():
+        return await asyncio.gather(
+            *(batcher.submit({"product_id": pid}, "interactive") for pid in answers),
+            return_exceptions=True,
+        )
+
+    return asyncio.run(main()), requested
+
+
+def test_each_item_gets_its_own_error(monkeypatch):
+    (r7, r404), requested = _batch(monkeypatch, {
+        7: [app.UpstreamHTTPError("HTTP 503", status=503)],
+        404: [app.UpstreamHTTPError("HTTP 404 not found", status=404)],
+    })
+    assert r7.status == 503
+    assert r404.status == 404
+    assert requested == [7, 404]
+
+
+def test_only_session_failures_are_retried(monkeypatch):
+    (r7, r8, r9), requested = _batch(monkeypatch, {
+        7: [RuntimeError("Target page, context or browser has been closed"), {"id": 7}],
+        8: [{"id": 8}],
+        9: [app.UpstreamHTTPError("HTTP 404", status=404)],
+    })
+    assert r7 == {"id": 7}
+    assert r8 == {"id": 8}
+    assert r9.status == 404
+    assert requested == [7, 8, 9, 7]
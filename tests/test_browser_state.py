@@ -0,0 +1,43 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import app
+
+
+def _api(state):
+    async def storage_state():
+        return state
+    return SimpleNamespace(ctx=SimpleNamespace(storage_state=storage_state))
+
+
+def test_file_store_save_and_invalidate(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "rds", None)
+    path = tmp_path / "state.json"
+    bs = app._BrowserState(60, 300, str(path))
+
+    async def main():
+        await bs.save(_api({"cookies": [1]}), "http://p1")
+        await bs.save(_api({"cookies": [2]}), "http://p2")
+        assert (await bs.load("http://p1")) == {"cookies": [1]}
+        await bs.invalidate("http://p1", "challenge")
+
+    asyncio.run(main())
+    data = json.loads(path.read_text())
+    assert list(data) == [bs._key("http://p2")]
+    # временные файлы за собой не оставляем
+    assert [p.name for p in tmp_path.iterdir()] == ["state.json"]
+
+
+def test_save_soon_does_not_snapshot_inline(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "rds", None)
+    bs = app._BrowserState(60, 300, str(tmp_path / "state.json"))
+
+    async def main():
+        bs.save_soon(_api({"cookies": []}), None)
+        assert bs.saves == 0
+        assert not bs.due(None)
+        await asyncio.gather(*bs._pending)
+        assert bs.saves == 1
+
+    asyncio.run(main())
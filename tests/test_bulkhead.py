@@ -0,0 +1,25 @@
+import asyncio
+
+import app
+
+
+def test_full_bulkhead_sends_retry_after(monkeypatch):
+    monkeypatch.setattr(app._latency, "percentile", lambda op, q: 2.0)
+    bulkhead = app._Bulkhead("tree", 1, 2)
+
+    async def main():
+        await bulkhead.acquire("interactive", "catalog_tree")
+        waiters = [asyncio.ensure_future(bulkhead.acquire("prefetch", "catalog_tree")) for _ in range(2)]
+        await asyncio.sleep(0)
+        try:
+            await bulkhead.acquire("interactive", "catalog_tree")
+        except app.UpstreamOverloaded as e:
+            return e
+        finally:
+            for w in waiters:
+                w.cancel()
+
+    e = asyncio.run(main())
+    # очередь 2 при лимите 1: (2 / 1 + 1) × 2 с
+    assert e.retry_after == 6.0
+    assert app._upstream_error_response(e).headers["Retry-After"] == "6"
@@ -0,0 +1,53 @@
+import asyncio
+
+import app
+
+
+def test_miss_entry_does_not_pin_parsed_data_in_l1(monkeypatch):
+    l1 = app._L1Cache({}, 1)
+    monkeypatch.setattr(app, "_l1", l1)
+    monkeypatch.setattr(app, "rds", None)
+    data = {"items": [{"id": i, "name": "Товар %d" % i} for i in range(100)]}
+    entry = app._CacheEntry.from_data(data)
+
+    asyncio.run(app.cache_set_entry("catalog:tree:c1", entry, 60))
+
+    stored, _left = l1.get("catalog:tree:c1")
+    assert stored._data is app._UNSET
+    assert stored.data == data
+    # ответ на промахе по-прежнему отдаёт уже разобранные данные без повторного разбора
+    assert entry.data is data
+
+
+def test_l1_hit_decode_is_not_kept_in_l1():
+    l1 = app._L1Cache({}, 1)
+    l1.set("offers:active", app._CacheEntry.from_data({"items": list(range(1000))}), 60)
+
+    first, _left = l1.get("offers:active")
+    assert first.data["items"][-1] == 999
+
+    again, _left = l1.get("offers:active")
+    assert again is not first
+    assert again._data is app._UNSET
+    assert l1.stats()["offers"]["bytes"] == again.size
+
+
+def test_explicit_q0_beats_wildcard():
+    entry = app._CacheEntry(b"{}", gz=b"gz", br=b"br")
+    assert entry.body_for("gzip;q=0, *") == (b"{}", None)
+    assert entry.body_for("gzip; q=0.0, br") == (b"br", "br")
+    assert entry.body_for("br;q=0, gzip;q=0.5") == (b"gz", "gzip")
+    assert entry.body_for("*") == (b"gz", "gzip")
+    assert entry.body_for("identity") == (b"{}", None)
+
+
+def test_l1_entry_of_another_codec_is_a_miss(monkeypatch):
+    l1 = app._L1Cache({}, 1)
+    monkeypatch.setattr(app, "_l1", l1)
+    monkeypatch.setattr(app, "rds", None)
+    other = app._Codec("msgpack", "msgpack", app._json_dumps, app.json.loads)
+    l1.set("offers:active", app._CacheEntry(b"{}", codec=other), 60)
+
+    assert asyncio.run(app.cache_get_entry("offers:active")) is None
+    stats = l1.stats()["offers"]
+    assert (stats["hits"], stats["misses"]) == (0, 1)
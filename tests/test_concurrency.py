@@ -0,0 +1,32 @@
+import random
+
+import app
+
+
+def _run(monkeypatch, latencies):
+    tracker = app._LatencyTracker(200)
+    monkeypatch.setattr(app, "_latency", tracker)
+    limit = app._ConcurrencyLimit(1, 8, True)
+    seen = []
+    for i, sec in enumerate(latencies):
+        tracker.observe("catalog_tree", sec)
+        # вызов начат после прошлого уменьшения — сигнал учитывается
+        limit.on_success(limit._decreased_at + 1e-9, "catalog_tree", sec, limit.current())
+        seen.append(limit.current())
+    return limit, seen
+
+
+def test_long_tail_alone_does_not_cut_the_limit(monkeypatch):
+    rnd = random.Random(1)
+    limit, seen = _run(monkeypatch, [rnd.lognormvariate(0, 0.5) for _ in range(5000)])
+    assert limit.decreases == 0
+    assert min(seen[300:]) == 8
+
+
+def test_sustained_slowdown_cuts_the_limit(monkeypatch):
+    rnd = random.Random(1)
+    healthy = [rnd.lognormvariate(0, 0.5) for _ in range(300)]
+    slow = [3 * rnd.lognormvariate(0, 0.5) for _ in range(20)]
+    limit, _seen = _run(monkeypatch, healthy + slow)
+    assert limit.decreases >= 1
+    assert limit.current() < 8
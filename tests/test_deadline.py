@@ -0,0 +1,65 @@
+import asyncio
+
+import app
+
+
+def test_client_disconnect_cancels_upstream_without_error(monkeypatch):
+    started = asyncio.Event()
+    cancelled = []
+
+    async def hanging_upstream(op, params=None, *, priority="interactive"):
+        started.set()
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.append(op)
+            raise
+
+    monkeypatch.setattr(app, "_upstream", hanging_upstream)
+    monkeypatch.setattr(app, "rds", None)
+    monkeypatch.setattr(app, "_l1", None)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/public/geo/cities",
+        "raw_path": b"/public/geo/cities",
+        "query_string": b"search=disconnect",
+        "root_path": "",
+        "headers": [(b"host", b"testserver")],
+        "client": ("127.0.0.1", 1),
+        "server": ("testserver", 80),
+    }
+    sent = []
+
+    async def main():
+        async def receive():
+            await started.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(msg):
+            sent.append(msg)
+
+        before = app._request_stats["client_disconnects"]
+        await asyncio.wait_for(app.app(scope, receive, send), 5)
+        await asyncio.sleep(0)
+        return app._request_stats["client_disconnects"] - before
+
+    assert asyncio.run(main()) == 1
+    assert cancelled == ["geo_cities"]
+    assert sent == []
+
+
+def test_invalid_budget_header_falls_back_to_path_default(monkeypatch):
+    monkeypatch.setattr(app, "REQUEST_BUDGETS", [("/public/geo", 15.0)])
+
+    def budget(value, path="/public/geo/cities"):
+        return app._request_budget({"path": path, "headers": [(b"x-request-budget-ms", value)]})
+
+    for bad in (b"NaN", b"-5", b"0", b"inf", b"soon"):
+        assert budget(bad) == 15.0
+    assert budget(b"NaN", "/public/offers/active") == app.REQUEST_BUDGET_SEC
+    assert budget(b"2500") == 2.5
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import app
+
+
+def _client(handler):
+    direct = app._DirectClient("http://chizhik.test/api/v1")
+    direct._client = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url=direct.base_url)
+    direct._headers = {"User-Agent": "test", "Cookie": "sid=1"}
+    direct._harvested_at = time.monotonic()
+    return direct
+
+
+def _upstream(monkeypatch, handler):
+    """app._upstream("geo_cities") с заглушкой апстрима и браузера; (результат или ошибка, вызовы браузера)."""
+    browser = []
+
+    async def call_chizhik(fn, *, op=None, priority="interactive", retry_restart=True):
+        browser.append(op)
+        return {"source": "browser"}
+
+    monkeypatch.setattr(app, "_direct", _client(handler))
+    monkeypatch.setattr(app, "_call_chizhik", call_chizhik)
+    monkeypatch.setattr(app, "BROKER_SOCKET", "")
+
+    async def main():
+        try:
+            return await app._upstream("geo_cities", {"search": "Мос"})
+        except Exception as e:
+            return e
+
+    return asyncio.run(main()), browser
+
+
+def test_direct_json_is_served_under_the_bulkhead(monkeypatch):
+    active = []
+
+    def handler(request):
+        active.append(app._bulkheads["geo"].active)
+        return httpx.Response(200, json={"items": [1]})
+
+    result, browser = _upstream(monkeypatch, handler)
+    assert result == {"items": [1]}
+    assert browser == []
+    assert active == [1]
+    assert app._bulkheads["geo"].active == 0
+
+
+@pytest.mark.parametrize("status", [401, 403])
+def test_challenge_status_falls_back_to_browser(monkeypatch, status):
+    result, browser = _upstream(monkeypatch, lambda request: httpx.Response(status))
+    assert result == {"source": "browser"}
+    assert browser == ["geo_cities"]
+    assert app._direct.needs_creds()
+
+
+def test_html_falls_back_to_browser(monkeypatch):
+    result, browser = _upstream(monkeypatch, lambda request: httpx.Response(200, text="<html>challenge</html>"))
+    assert result == {"source": "browser"}
+    assert browser == ["geo_cities"]
+    assert app._direct.fallbacks == {"challenge": 1}
+
+
+def test_5xx_falls_back_to_browser(monkeypatch):
+    result, browser = _upstream(monkeypatch, lambda request: httpx.Response(502))
+    assert result == {"source": "browser"}
+    assert browser == ["geo_cities"]
+    # cookies не виноваты — следующий вызов снова пойдёт напрямую
+    assert not app._direct.needs_creds()
+
+
+def test_404_is_passed_through(monkeypatch):
+    result, browser = _upstream(monkeypatch, lambda request: httpx.Response(404, json={"detail": "not found"}))
+    assert isinstance(result, app.UpstreamHTTPError)
+    assert result.status == 404
+    assert browser == []
+
+
+def test_429_is_passed_through_with_retry_after_and_keeps_cookies(monkeypatch):
+    result, browser = _upstream(monkeypatch, lambda request: httpx.Response(429, headers={"Retry-After": "7"}))
+    assert isinstance(result, app.UpstreamHTTPError)
+    assert result.status == 429
+    assert result.retry_after == 7
+    assert browser == []
+    assert not app._direct.needs_creds()
@@ -0,0 +1,13 @@
+import app
+
+
+def test_upstream_error_response_codes():
+    assert app._upstream_error_response(app.UpstreamHTTPError("HTTP 404", status=404)).status_code == 404
+    assert app._upstream_error_response(app.UpstreamHTTPError("HTTP 403", status=403)).status_code == 503
+
+    overloaded = app._upstream_error_response(app.UpstreamOverloaded("queue full", retry_after=1.2))
+    assert overloaded.status_code == 429
+    assert overloaded.headers["Retry-After"] == "2"
+
+    assert app._upstream_error_response(app.DeadlineExceeded("late")).status_code == 504
+    assert app._upstream_error_response(RuntimeError("boom")).status_code == 503
@@ -0,0 +1,59 @@
+import asyncio
+from types import SimpleNamespace
+
+import app
+
+
+def _hedge(monkeypatch, active, no_idle=False):
+    """Медленный основной вызов geo_cities при active занятых слотах bulkhead'а на 2; (hedger, bulkhead, число вызовов)."""
+    calls = []
+    bulkhead = app._Bulkhead("geo", 2, 10)
+    bulkhead.active = active
+
+    async def call_session(fn, *, op, priority, retry_restart, wait=True, on_checkout=None):
+        calls.append(wait)
+        if not wait and no_idle:
+            raise app._NoIdleSession("no idle session")
+        if on_checkout is not None:
+            on_checkout(None)
+        await asyncio.sleep(0.2 if wait else 0.01)
+        return "primary" if wait else "hedge"
+
+    monkeypatch.setattr(app, "_call_session", call_session)
+    monkeypatch.setattr(app, "_pool", SimpleNamespace(sessions=[1, 2], has_idle=lambda: True))
+    monkeypatch.setattr(app, "_bulkheads", {"geo": bulkhead})
+    monkeypatch.setattr(app._latency, "percentile", lambda op, q: 0.01)
+    hedger = app._Hedger(1.0)
+
+    async def main():
+        result = await hedger.call(None, op="geo_cities", priority="interactive", retry_restart=True)
+        await asyncio.sleep(0)
+        return result
+
+    return asyncio.run(main()), hedger, bulkhead, calls
+
+
+def test_hedge_takes_and_returns_a_bulkhead_slot(monkeypatch):
+    result, hedger, bulkhead, calls = _hedge(monkeypatch, active=1)
+    assert result == "hedge"
+    assert calls == [True, False]
+    assert bulkhead.active == 1
+
+
+def test_no_hedge_when_bulkhead_is_full(monkeypatch):
+    result, hedger, bulkhead, calls = _hedge(monkeypatch, active=2)
+    assert result == "primary"
+    assert calls == [True]
+    assert hedger.stats()["skipped_no_slot"] == 1
+    assert bulkhead.active == 2
+
+
+def test_hedge_without_a_browser_is_not_charged(monkeypatch):
+    result, hedger, bulkhead, calls = _hedge(monkeypatch, active=1, no_idle=True)
+    assert result == "primary"
+    assert calls == [True, False]
+    stats = hedger.stats()
+    assert stats["hedged"] == 0
+    assert stats["skipped_no_idle"] == 1
+    assert stats["tokens"] == 1.0
+    assert bulkhead.active == 1
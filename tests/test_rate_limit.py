@@ -0,0 +1,84 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import app
+
+
+def _session_call(monkeypatch, errors):
+    """_call_session на заглушке пула: fn бросает errors по очереди, потом отвечает; (результат, события)."""
+    events = []
+    session = SimpleNamespace(id=0, proxy=None)
+
+    async def ensure():
+        return SimpleNamespace()
+
+    session.ensure = ensure
+    session.mark_ok = lambda: None
+    session.mark_error = lambda e: None
+    session.restart = lambda: events.append("restart")
+
+    @asynccontextmanager
+    async def checkout(priority, wait):
+        yield session
+
+    async def resolve_challenge(api):
+        events.append("challenge")
+
+    async def invalidate(proxy, reason):
+        events.append("invalidate")
+
+    async def sleep(sec):
+        events.append(("sleep", sec))
+
+    pool = SimpleNamespace(
+        session=checkout,
+        proxy_result=lambda *a, **kw: None,
+        concurrency_sample=lambda *a, **kw: None,
+    )
+    monkeypatch.setattr(app, "_pool", pool)
+    monkeypatch.setattr(app, "_direct", None)
+    monkeypatch.setattr(app, "_resolve_challenge", resolve_challenge)
+    monkeypatch.setattr(app._browser_state, "invalidate", invalidate)
+    monkeypatch.setattr(app.asyncio, "sleep", sleep)
+
+    async def fn(api):
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    async def main():
+        try:
+            return await app._call_session(fn, op="geo_cities", priority="interactive", retry_restart=True)
+        except Exception as e:
+            return e
+
+    return asyncio.run(main()), events
+
+
+def test_429_backs_off_by_retry_after_and_keeps_the_session(monkeypatch):
+    result, events = _session_call(monkeypatch, [app.UpstreamHTTPError("HTTP 429", retry_after=1.5, status=429)])
+    assert result == "ok"
+    assert events == [("sleep", 1.5)]
+
+
+def test_429_with_long_retry_after_is_returned(monkeypatch):
+    result, events = _session_call(monkeypatch, [app.UpstreamHTTPError("HTTP 429", retry_after=120, status=429)])
+    assert result.status == 429
+    assert events == []
+    response = app._upstream_error_response(result)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "120"
+
+
+def test_403_still_resolves_the_challenge(monkeypatch):
+    result, events = _session_call(monkeypatch, [app.UpstreamHTTPError("HTTP 403", status=403)])
+    assert result == "ok"
+    assert events == ["invalidate", "challenge"]
+
+
+def test_retry_after_header_forms():
+    assert app._retry_after_sec({"retry-after": "3"}) == 3
+    assert app._retry_after_sec({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
+    assert app._retry_after_sec({"retry-after": "soon"}) is None
+    assert app._retry_after_sec(None) is None
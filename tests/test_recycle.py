@@ -0,0 +1,25 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import app
+
+
+def _fake_api(pid):
+    proc = SimpleNamespace(pid=pid)
+    conn = SimpleNamespace(_transport=SimpleNamespace(_proc=proc))
+    # как у playwright: публичная обёртка Browser, соединение — у _impl_obj
+    return SimpleNamespace(session=SimpleNamespace(_impl_obj=SimpleNamespace(_connection=conn)))
+
+
+def test_root_pid_from_playwright_impl_obj():
+    assert app._api_root_pid(_fake_api(os.getpid())) == os.getpid()
+    assert app._tree_rss_mb(os.getpid()) > 0
+
+
+def test_unknown_pid_is_reported():
+    s = app._Session(0)
+    s.api = SimpleNamespace(session=SimpleNamespace())
+    asyncio.run(app._pool._measure_rss(s))
+    assert s.rss_mb is None
+    assert s.stats()["rss_error"] == "browser pid unknown"
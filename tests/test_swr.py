@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+import app
+
+
+def _run_revalidate(monkeypatch, redis_hit):
+    seen = {"fetches": 0, "deadline": "unset", "skip_l1": None}
+
+    async def lock(key, ttl=60):
+        return True
+
+    async def unlock(key):
+        pass
+
+    async def get_entry(key, codec=None, *, skip_l1=False):
+        seen["skip_l1"] = skip_l1
+        return redis_hit
+
+    async def fetch():
+        seen["fetches"] += 1
+        seen["deadline"] = app._deadline_var.get()
+
+    monkeypatch.setattr(app, "cache_lock", lock)
+    monkeypatch.setattr(app, "cache_unlock", unlock)
+    monkeypatch.setattr(app, "cache_get_entry", get_entry)
+
+    async def main():
+        # обновление запускает запрос со своим дедлайном
+        app._deadline_var.set(time.monotonic() + 1)
+        app._revalidate("catalog:tree:c1", fetch, fresh_left=60)
+        await app._swr_refreshing["catalog:tree:c1"]
+
+    asyncio.run(main())
+    return seen
+
+
+def test_refresh_skipped_when_redis_already_fresh(monkeypatch):
+    entry = app._CacheEntry.from_data({"a": 1})
+    seen = _run_revalidate(monkeypatch, (entry, 90))
+    assert seen["skip_l1"] is True
+    assert seen["fetches"] == 0
+
+
+def test_refresh_runs_without_request_deadline(monkeypatch):
+    entry = app._CacheEntry.from_data({"a": 1})
+    seen = _run_revalidate(monkeypatch, (entry, 30))
+    assert seen["fetches"] == 1
+    assert seen["deadline"] is None
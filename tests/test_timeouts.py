@@ -0,0 +1,30 @@
+import asyncio
+
+import app
+
+
+def test_timeouts_do_not_ratchet_the_adaptive_timeout(monkeypatch):
+    tracker = app._LatencyTracker(200)
+    monkeypatch.setattr(app, "_latency", tracker)
+    for _ in range(198):
+        tracker.observe("geo_cities", 0.3)
+    base = tracker.timeout_for("geo_cities")
+    assert base == app.TIMEOUT_FLOOR_SEC
+
+    monkeypatch.setattr(tracker, "timeout_for", lambda op: 0.01)
+
+    async def hang(api):
+        await asyncio.sleep(1)
+
+    async def main():
+        for _ in range(6):
+            try:
+                await app._timed(hang, None, "geo_cities")
+            except asyncio.TimeoutError:
+                pass
+
+    asyncio.run(main())
+    monkeypatch.undo()
+    assert tracker.timeouts["geo_cities"] == 6
+    assert app._LatencyTracker.timeout_for(tracker, "geo_cities") == base
+    assert tracker.stats()["geo_cities"]["timeouts"] == 6
@@ -0,0 +1,29 @@
+import asyncio
+
+import app
+
+
+def test_warm_cache_does_not_hide_dead_browsers(monkeypatch):
+    l1 = app._L1Cache({}, 1)
+    l1.set("offers:active", app._CacheEntry.from_data({"items": []}), 600)
+    monkeypatch.setattr(app, "_l1", l1)
+    monkeypatch.setattr(app, "rds", None)
+    monkeypatch.setattr(app, "_warmup_items", lambda: [])
+    monkeypatch.setattr(app._standby, "refill", lambda: None)
+
+    async def start_all():
+        return [RuntimeError("browser launch failed")] * len(app._pool.sessions)
+
+    async def monitor():
+        pass
+
+    async def call_chizhik(fn, *, op=None, priority="interactive", retry_restart=True):
+        raise app.UpstreamUnavailable("browser launch failed")
+
+    monkeypatch.setattr(app._pool, "start_all", start_all)
+    monkeypatch.setattr(app._pool, "monitor", monitor)
+    monkeypatch.setattr(app, "_call_chizhik", call_chizhik)
+
+    asyncio.run(app._warmup_task())
+    assert app._warmup_state["status"] == "error"
+    assert app._warmup_state["error"] == "browser launch failed"